@@ -14,14 +14,34 @@
 
 """Utility methods for managing Apple bundles."""
 
-import glob
+import concurrent.futures
+import functools
 import os
+import re
+import shutil
+import stat
 import subprocess
 import tempfile
+import zipfile
 
 from xctestrunner.shared import ios_errors
 from xctestrunner.shared import plist_util
 
+# Set the environment variable to 1 to extract the bundles by zipfile instead
+# of bsdtar.
+_INPROC_UNZIP_ENV = 'XCTESTRUNNER_INPROC_UNZIP'
+_CODESIGN_INFO_PATTERNS = {
+    'Authority': re.compile(r'^Authority=(.*)$', re.MULTILINE),
+    'TeamIdentifier': re.compile(r'^TeamIdentifier=(.*)$', re.MULTILINE),
+}
+
+# The cache of `codesign -dvv` results. The key is the bundle path and the value
+# is a tuple of (bundle's st_mtime_ns, codesign info dict).
+_codesign_info_cache = {}
+# The cache of `lipo -archs` results. The key is the file path and the value is
+# a tuple of ((file's st_mtime_ns, st_size), arch types list).
+_arch_types_cache = {}
+
 
 def ExtractApp(compressed_app_path, working_dir):
   """Creates a temp directory and extracts compressed file of the app there.
@@ -44,8 +64,8 @@ def ExtractApp(compressed_app_path, working_dir):
     ios_errors.BundleError(
         'The extension of the compressed file should be .ipa.')
   unzip_target_dir = tempfile.mkdtemp(dir=working_dir)
-  _UnzipWithShell(compressed_app_path, unzip_target_dir)
-  return _ExtractBundleFile('%s/Payload' % unzip_target_dir, 'app')
+  _Unzip(compressed_app_path, unzip_target_dir)
+  return _ExtractBundleFile(os.path.join(unzip_target_dir, 'Payload'), 'app')
 
 
 def ExtractTestBundle(compressed_test_path, working_dir):
@@ -70,11 +90,12 @@ def ExtractTestBundle(compressed_test_path, working_dir):
     ios_errors.BundleError(
         'The extension of the compressed file should be .ipa/zip.')
   unzip_target_dir = tempfile.mkdtemp(dir=working_dir)
-  _UnzipWithShell(compressed_test_path, unzip_target_dir)
+  _Unzip(compressed_test_path, unzip_target_dir)
   try:
     return _ExtractBundleFile(unzip_target_dir, 'xctest')
   except ios_errors.BundleError:
-    return _ExtractBundleFile('%s/Payload' % unzip_target_dir, 'xctest')
+    return _ExtractBundleFile(
+        os.path.join(unzip_target_dir, 'Payload'), 'xctest')
 
 
 def GetMinimumOSVersion(bundle_path):
@@ -90,8 +111,7 @@ def GetMinimumOSVersion(bundle_path):
     ios_errors.PlistError: the MinimumOSVersion does not exist in the bundle's
       Info.plist.
   """
-  info_plist = os.path.join(bundle_path, 'Info.plist')
-  return plist_util.Plist(info_plist).GetPlistField('MinimumOSVersion')
+  return _GetInfoPlist(bundle_path).GetPlistField('MinimumOSVersion')
 
 
 def GetBundleId(bundle_path):
@@ -107,8 +127,7 @@ def GetBundleId(bundle_path):
     ios_errors.PlistError: the CFBundleIdentifier does not exist in the bundle's
       Info.plist.
   """
-  info_plist = os.path.join(bundle_path, 'Info.plist')
-  return plist_util.Plist(info_plist).GetPlistField('CFBundleIdentifier')
+  return _GetInfoPlist(bundle_path).GetPlistField('CFBundleIdentifier')
 
 
 def GetCodesignIdentity(bundle_path):
@@ -124,16 +143,11 @@ def GetCodesignIdentity(bundle_path):
     ios_errors.BundleError: when failed to get the signing identity from the
       bundle.
   """
-  command = ('codesign', '-dvv', bundle_path)
-  process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-  output = process.communicate()[0].decode('utf-8')
-  for line in output.split('\n'):
-    if line.startswith('Authority='):
-      return line[len('Authority='):]
-
-  raise ios_errors.BundleError('Failed to extract signing identity from %s' %
-                               output)
+  codesign_info = _GetCodesignInfo(bundle_path)
+  if 'Authority' not in codesign_info:
+    raise ios_errors.BundleError('Failed to extract signing identity from %s' %
+                                 codesign_info['output'])
+  return codesign_info['Authority']
 
 
 def GetDevelopmentTeam(bundle_path):
@@ -149,16 +163,11 @@ def GetDevelopmentTeam(bundle_path):
     ios_errors.BundleError: when failed to get the development team from the
       bundle.
   """
-  command = ('codesign', '-dvv', bundle_path)
-  process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-  output = process.communicate()[0].decode('utf-8')
-  for line in output.split('\n'):
-    if line.startswith('TeamIdentifier='):
-      return line[len('TeamIdentifier='):]
-
-  raise ios_errors.BundleError('Failed to extract development team from %s' %
-                               output)
+  codesign_info = _GetCodesignInfo(bundle_path)
+  if 'TeamIdentifier' not in codesign_info:
+    raise ios_errors.BundleError('Failed to extract development team from %s' %
+                                 codesign_info['output'])
+  return codesign_info['TeamIdentifier']
 
 
 def CodesignBundle(bundle_path,
@@ -174,29 +183,60 @@ def CodesignBundle(bundle_path,
   Raises:
     ios_errors.BundleError: when failed to codesign the bundle.
   """
-  if identity is None:
-    identity = GetCodesignIdentity(bundle_path)
-  try:
+  CodesignBundles([bundle_path],
+                  entitlements_plist_path=entitlements_plist_path,
+                  identity=identity)
+
+
+def CodesignBundles(bundle_paths,
+                    entitlements_plist_path=None,
+                    identity=None):
+  """Codesigns the bundles in as few codesign invocations as possible.
+
+  The bundles are signed in the given order, so the nested bundles should be
+  placed before the bundles containing them.
+
+  Args:
+    bundle_paths: a list of string, full paths of bundle folders.
+    entitlements_plist_path: string, the path of the Entitlement to sign
+      bundles.
+    identity: string, the identity to sign bundles. If it is not provided,
+      each bundle is signed with the identity which it is currently signed
+      with.
+
+  Raises:
+    ios_errors.BundleError: when failed to codesign the bundles.
+  """
+  # Groups the consecutive bundles with the same identity into one codesign
+  # command to keep the signing order.
+  bundle_groups = []
+  for bundle_path in bundle_paths:
+    bundle_identity = identity
+    if bundle_identity is None:
+      bundle_identity = GetCodesignIdentity(bundle_path)
+    if bundle_groups and bundle_groups[-1][0] == bundle_identity:
+      bundle_groups[-1][1].append(bundle_path)
+    else:
+      bundle_groups.append((bundle_identity, [bundle_path]))
+
+  for bundle_identity, grouped_bundle_paths in bundle_groups:
     if entitlements_plist_path is None:
-      subprocess.check_call(
-          [
-              'codesign', '-f', '--preserve-metadata=identifier,entitlements',
-              '--timestamp=none', '-s', identity, bundle_path
-          ],
-          stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE)
+      command = ['codesign', '-f',
+                 '--preserve-metadata=identifier,entitlements']
     else:
+      command = ['codesign', '-f', '--entitlements', entitlements_plist_path]
+    command.extend(['--timestamp=none', '-s', bundle_identity])
+    command.extend(grouped_bundle_paths)
+    try:
       subprocess.check_call(
-          [
-              'codesign', '-f', '--entitlements', entitlements_plist_path,
-              '--timestamp=none', '-s', identity, bundle_path
-          ],
-          stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE)
-  except subprocess.CalledProcessError as e:
-    raise ios_errors.BundleError(
-        'Failed to codesign the bundle %s with %s: %s' %
-        (bundle_path, identity, e.output))
+          command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+      raise ios_errors.BundleError(
+          'Failed to codesign the bundles %s with %s: %s' %
+          (grouped_bundle_paths, bundle_identity, e.output))
+    finally:
+      for bundle_path in grouped_bundle_paths:
+        _codesign_info_cache.pop(bundle_path, None)
 
 
 def EnableUIFileSharing(bundle_path, resigning=True):
@@ -210,23 +250,87 @@ def EnableUIFileSharing(bundle_path, resigning=True):
   Raises:
     ios_errors.BundleError: when failed to codesign the bundle.
   """
-  info_plist = plist_util.Plist(os.path.join(bundle_path, 'Info.plist'))
-  info_plist.SetPlistField('UIFileSharingEnabled', True)
+  _GetInfoPlist(bundle_path).SetPlistField('UIFileSharingEnabled', True)
   if resigning:
     CodesignBundle(bundle_path)
 
 
 def GetFileArchTypes(file_path):
   """Gets the architecture types of the file."""
-  output = subprocess.check_output(['/usr/bin/lipo', file_path,
-                                    '-archs']).decode('utf-8').strip()
-  return output.split(' ')
+  file_stat = os.stat(file_path)
+  stat_key = (file_stat.st_mtime_ns, file_stat.st_size)
+  cache_entry = _arch_types_cache.get(file_path)
+  if cache_entry and cache_entry[0] == stat_key:
+    return list(cache_entry[1])
+
+  output = subprocess.run(
+      ['/usr/bin/lipo', file_path, '-archs'], check=True,
+      stdout=subprocess.PIPE, text=True).stdout.strip()
+  arch_types = output.split(' ')
+  _arch_types_cache[file_path] = (stat_key, arch_types)
+  return list(arch_types)
 
 
 def RemoveArchType(file_path, arch_type):
   """Remove the given architecture types for the file."""
-  subprocess.check_call(
-      ['/usr/bin/lipo', file_path, '-remove', arch_type, '-output', file_path])
+  RemoveArchTypes(file_path, [arch_type])
+
+
+def RemoveArchTypes(file_path, arch_types, output_path=None):
+  """Remove the given architecture types for the file in one lipo rewrite.
+
+  Args:
+    file_path: string, the path of the multi-archs file.
+    arch_types: list of string, the architecture types to remove.
+    output_path: string, the path of the output file. By default, the file is
+      rewritten in place.
+  """
+  output_path = output_path or file_path
+  command = ['/usr/bin/lipo', file_path]
+  for arch_type in arch_types:
+    command.extend(['-remove', arch_type])
+  command.extend(['-output', output_path])
+  try:
+    subprocess.check_call(command)
+  finally:
+    _arch_types_cache.pop(output_path, None)
+
+
+@functools.lru_cache(maxsize=256)
+def _GetInfoPlist(bundle_path):
+  """Gets the plist_util.Plist object of the bundle's Info.plist."""
+  return plist_util.Plist(os.path.join(bundle_path, 'Info.plist'))
+
+
+def _GetCodesignInfo(bundle_path):
+  """Gets the signing information of the bundle by `codesign -dvv`.
+
+  The result is cached until the bundle is modified or resigned.
+
+  Args:
+    bundle_path: string, full path of bundle folder.
+
+  Returns:
+    a dict contains the raw command output under the key 'output' and the
+    found fields of Authority and TeamIdentifier.
+  """
+  mtime_ns = os.stat(bundle_path).st_mtime_ns
+  cache_entry = _codesign_info_cache.get(bundle_path)
+  if cache_entry and cache_entry[0] == mtime_ns:
+    return cache_entry[1]
+
+  output = subprocess.run(
+      ('codesign', '-dvv', bundle_path),
+      stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True).stdout
+  codesign_info = {'output': output}
+  for field, pattern in _CODESIGN_INFO_PATTERNS.items():
+    # Only the first Authority is the signing identity. The others are the
+    # certificate chain.
+    match = pattern.search(output)
+    if match:
+      codesign_info[field] = match.group(1)
+  _codesign_info_cache[bundle_path] = (mtime_ns, codesign_info)
+  return codesign_info
 
 
 def _ExtractBundleFile(target_dir, bundle_extension):
@@ -243,7 +347,14 @@ def _ExtractBundleFile(target_dir, bundle_extension):
     BundleError: when bundle is not found or multiple bundles are found in the
       directory.
   """
-  extracted_bundles = glob.glob('%s/*.%s' % (target_dir, bundle_extension))
+  bundle_suffix = '.' + bundle_extension
+  extracted_bundles = []
+  if os.path.isdir(target_dir):
+    with os.scandir(target_dir) as entries:
+      for entry in entries:
+        if (entry.name.endswith(bundle_suffix) and
+            not entry.name.startswith('.')):
+          extracted_bundles.append(entry.path)
   if not extracted_bundles:
     raise ios_errors.BundleError(
         'No file with extension %s is found under %s.'
@@ -256,15 +367,127 @@ def _ExtractBundleFile(target_dir, bundle_extension):
   return extracted_bundles[0]
 
 
-def _UnzipWithShell(src_file_path, des_file_path):
-  """Unzips the file in shell.
+def _Unzip(src_file_path, des_file_path):
+  """Unzips the file and keeps the file permission bits.
 
   Args:
     src_file_path: string, full path of the file to be unzipped.
     des_file_path: string, full path of the extracted file.
   """
   # Python zipfile extractall method silently removes file permission bits.
-  # See https://bugs.python.org/issue15795. As workaround for now, use shell
-  # command unzip.
-  subprocess.check_call(['unzip', '-q', '-o',
-                         src_file_path, '-d', des_file_path])
+  # See https://bugs.python.org/issue15795. Uses bsdtar which ships with MacOS
+  # and keeps the permission bits. If it is not available or the in-process
+  # extraction is forced by environment variable, extracts the entries by
+  # zipfile and restores the permission bits from the entries' attributes.
+  if os.environ.get(_INPROC_UNZIP_ENV) != '1' and shutil.which('bsdtar'):
+    subprocess.check_call(['bsdtar', '-xf', src_file_path,
+                           '-C', des_file_path])
+    return
+  _UnzipInParallel(src_file_path, des_file_path)
+
+
+def _UnzipInParallel(src_file_path, des_file_path):
+  """Unzips the file with multiple workers and keeps file permission bits.
+
+  Args:
+    src_file_path: string, full path of the file to be unzipped.
+    des_file_path: string, full path of the extracted file.
+
+  Raises:
+    ios_errors.BundleError: if an entry of the zip file points outside of the
+      destination.
+  """
+  des_real_path = os.path.realpath(des_file_path)
+  with zipfile.ZipFile(src_file_path) as zip_file:
+    zip_infos = zip_file.infolist()
+  for zip_info in zip_infos:
+    _CheckPathInDir(
+        os.path.join(des_real_path, zip_info.filename), des_real_path,
+        zip_info.filename)
+  link_infos = []
+  file_infos = []
+  for zip_info in zip_infos:
+    if stat.S_ISLNK(zip_info.external_attr >> 16):
+      link_infos.append(zip_info)
+    elif not zip_info.is_dir():
+      file_infos.append(zip_info)
+  # Creates the directory tree up front to avoid the workers racing on it.
+  for zip_info in zip_infos:
+    dir_name = (zip_info.filename if zip_info.is_dir() else
+                os.path.dirname(zip_info.filename))
+    if dir_name:
+      os.makedirs(os.path.join(des_real_path, dir_name), exist_ok=True)
+  # The zlib decompression releases GIL, so threads are enough here.
+  shards = _ShardZipInfos(file_infos, os.cpu_count() or 1)
+  with concurrent.futures.ThreadPoolExecutor(
+      max(len(shards), 1)) as executor:
+    # Consumes the results to surface the exceptions raised in workers.
+    list(executor.map(
+        functools.partial(_ExtractZipInfos, src_file_path, des_real_path),
+        shards))
+  # Restores the directory permission bits before creating the symlinks, so
+  # that no path is resolved through a symlink of the zip file.
+  for zip_info in zip_infos:
+    mode = zip_info.external_attr >> 16
+    if zip_info.is_dir() and mode:
+      os.chmod(os.path.join(des_real_path, zip_info.filename),
+               stat.S_IMODE(mode))
+  # Creates the symlinks at last, so no entry is extracted through them.
+  if link_infos:
+    with zipfile.ZipFile(src_file_path) as zip_file:
+      for zip_info in link_infos:
+        _ExtractSymlink(zip_file, zip_info, des_real_path)
+    # A symlink created later may redirect the target of an earlier one, so
+    # checks all of them again once they are in place.
+    for zip_info in link_infos:
+      _CheckPathInDir(os.path.join(des_real_path, zip_info.filename),
+                      des_real_path, zip_info.filename)
+
+
+def _CheckPathInDir(path, dir_path, entry_name):
+  """Raises BundleError if the real path of path is not under dir_path."""
+  real_path = os.path.realpath(path)
+  if real_path != dir_path and not real_path.startswith(
+      os.path.join(dir_path, '')):
+    raise ios_errors.BundleError(
+        'The zip entry %s points outside of %s.' % (entry_name, dir_path))
+
+
+def _ExtractSymlink(zip_file, zip_info, des_file_path):
+  """Creates the symlink entry if its target stays under des_file_path."""
+  link_path = os.path.join(des_file_path, zip_info.filename.rstrip('/'))
+  link_target = zip_file.read(zip_info).decode('utf-8')
+  if os.path.isabs(link_target):
+    raise ios_errors.BundleError(
+        'The zip entry %s links to the absolute path %s.' %
+        (zip_info.filename, link_target))
+  # The parent may go through a symlink created before, so resolves it again.
+  link_dir = os.path.dirname(link_path)
+  _CheckPathInDir(link_dir, des_file_path, zip_info.filename)
+  _CheckPathInDir(os.path.join(os.path.realpath(link_dir), link_target),
+                  des_file_path, zip_info.filename)
+  if os.path.lexists(link_path):
+    os.remove(link_path)
+  os.symlink(link_target, link_path)
+
+
+def _ShardZipInfos(zip_infos, shard_num):
+  """Splits the zip entries into shards with balanced compressed size."""
+  shards = [[] for _ in range(min(shard_num, len(zip_infos)))]
+  shard_sizes = [0] * len(shards)
+  for zip_info in sorted(
+      zip_infos, key=lambda info: info.compress_size, reverse=True):
+    index = shard_sizes.index(min(shard_sizes))
+    shards[index].append(zip_info)
+    shard_sizes[index] += zip_info.compress_size
+  return shards
+
+
+def _ExtractZipInfos(src_file_path, des_file_path, zip_infos):
+  """Extracts the zip entries with a private file handle of the zip file."""
+  with zipfile.ZipFile(src_file_path) as zip_file:
+    for zip_info in zip_infos:
+      mode = zip_info.external_attr >> 16
+      extracted_path = zip_file.extract(zip_info, des_file_path)
+      if mode:
+        os.chmod(extracted_path, stat.S_IMODE(mode))
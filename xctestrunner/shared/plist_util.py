@@ -14,11 +14,24 @@
 
 """Utility class for managing Plist files."""
 
+import copy
+import mmap
 import os
 import plistlib
+import shutil
+import tempfile
+import threading
 
 from xctestrunner.shared import ios_errors
 
+_BINARY_PLIST_HEADER = b'bplist00'
+
+# The cache of parsed plist root objects. The key is the .plist file path and
+# the value is a tuple of ((st_mtime_ns, st_size), root object). The cached
+# root objects are shared and must not be mutated.
+_plist_cache = {}
+_plist_cache_lock = threading.Lock()
+
 
 class Plist(object):
   """Handles the .plist file operations."""
@@ -48,9 +61,29 @@ class Plist(object):
     Raises:
       ios_errors.PlistError: the field does not exist in the plist dict.
     """
-    with open(self._plist_file_path, 'rb') as plist_file:
-      plist_root_object = plistlib.load(plist_file)
-    return _GetObjectWithField(plist_root_object, field)
+    plist_root_object = _LoadPlistRootObject(self._plist_file_path)
+    return _CopyIfMutable(_GetObjectWithField(plist_root_object, field))
+
+  def GetPlistFieldOrDefault(self, field, default=None):
+    """View specific field in the .plist file without raising error.
+
+    Args:
+      field: string, the field consist of property key names delimited by
+        colons. List(array) items are specified by a zero-based integer index.
+        Examples
+          :CFBundleShortVersionString
+          :CFBundleDocumentTypes:2:CFBundleTypeExtensions
+      default: a object, the value to return if the field does not exist.
+
+    Returns:
+      the object of the plist's field or the default value if the field does
+      not exist.
+    """
+    plist_root_object = _LoadPlistRootObject(self._plist_file_path)
+    has_field, field_object = _TryGetObjectWithField(plist_root_object, field)
+    if not has_field:
+      return default
+    return _CopyIfMutable(field_object)
 
   def HasPlistField(self, field):
     """Checks whether a specific field is in the .plist file.
@@ -65,11 +98,8 @@ class Plist(object):
     Returns:
       whether the field is in the plist's file.
     """
-    try:
-      self.GetPlistField(field)
-    except ios_errors.PlistError:
-      return False
-    return True
+    plist_root_object = _LoadPlistRootObject(self._plist_file_path)
+    return _TryGetObjectWithField(plist_root_object, field)[0]
 
   def SetPlistField(self, field, value):
     """Set field with provided value in .plist file.
@@ -87,31 +117,45 @@ class Plist(object):
       ios_errors.PlistError: the field does not exist in the .plist file's dict.
     """
     if not field:
-      with open(self._plist_file_path, 'wb') as plist_file:
-        plistlib.dump(value, plist_file)
+      _DumpPlistRootObject(self._plist_file_path, copy.deepcopy(value))
       return
+    self.SetPlistFields({field: value})
 
+  def SetPlistFields(self, fields):
+    """Set multiple fields with provided values in .plist file at once.
+
+    The .plist file is loaded and dumped only once for all fields.
+
+    Args:
+      fields: dict, the key is the field and the value is the value of the
+        field to be added. The field consist of property key names delimited by
+        colons. It can not be empty. The value can be integer, bool, string,
+        array, dict.
+
+    Raises:
+      ios_errors.PlistError: the field does not exist in the .plist file's dict.
+    """
     if os.path.exists(self._plist_file_path):
-      with open(self._plist_file_path, 'rb') as plist_file:
-        plist_root_object = plistlib.load(plist_file)
+      plist_root_object = copy.deepcopy(
+          _LoadPlistRootObject(self._plist_file_path))
     else:
       plist_root_object = {}
-    keys_in_field = field.rsplit(':', 1)
-    if len(keys_in_field) == 1:
-      key = field
-      target_object = plist_root_object
-    else:
-      key = keys_in_field[1]
-      target_object = _GetObjectWithField(plist_root_object, keys_in_field[0])
-    try:
-      target_object[_ParseKey(target_object, key)] = value
-    except ios_errors.PlistError as e:
-      raise e
-    except (KeyError, IndexError):
-      raise ios_errors.PlistError('Failed to set key %s from object %s.'
-                                  % (key, target_object))
-    with open(self._plist_file_path, 'wb') as plist_file:
-      plistlib.dump(plist_root_object, plist_file)
+    changed = False
+    for field, value in fields.items():
+      target_object, key = _GetParentObjectWithField(plist_root_object, field)
+      try:
+        parsed_key = _ParseKey(target_object, key)
+        if _IsSameValue(target_object, parsed_key, value):
+          continue
+        target_object[parsed_key] = copy.deepcopy(value)
+      except ios_errors.PlistError as e:
+        raise e
+      except (KeyError, IndexError):
+        raise ios_errors.PlistError('Failed to set key %s from object %s.'
+                                    % (key, target_object))
+      changed = True
+    if changed:
+      _DumpPlistRootObject(self._plist_file_path, plist_root_object)
 
   def DeletePlistField(self, field):
     """Delete field in .plist file.
@@ -126,15 +170,9 @@ class Plist(object):
     Raises:
       ios_errors.PlistError: the field does not exist in the .plist file's dict.
     """
-    with open(self._plist_file_path, 'rb') as plist_file:
-      plist_root_object = plistlib.load(plist_file)
-    keys_in_field = field.rsplit(':', 1)
-    if len(keys_in_field) == 1:
-      key = field
-      target_object = plist_root_object
-    else:
-      key = keys_in_field[1]
-      target_object = _GetObjectWithField(plist_root_object, keys_in_field[0])
+    plist_root_object = copy.deepcopy(
+        _LoadPlistRootObject(self._plist_file_path))
+    target_object, key = _GetParentObjectWithField(plist_root_object, field)
 
     try:
       del target_object[_ParseKey(target_object, key)]
@@ -144,8 +182,98 @@ class Plist(object):
       raise ios_errors.PlistError('Failed to delete key %s from object %s.'
                                   % (key, target_object))
 
-    with open(self._plist_file_path, 'wb') as plist_file:
+    _DumpPlistRootObject(self._plist_file_path, plist_root_object)
+
+
+def _LoadPlistRootObject(plist_file_path):
+  """Loads the root object of the .plist file.
+
+  The parsed root object is cached until the file's mtime or size changes.
+
+  Args:
+    plist_file_path: string, the path of the .plist file.
+
+  Returns:
+    the root object of the .plist file. It is shared with the cache and must
+    not be mutated.
+  """
+  plist_stat = os.stat(plist_file_path)
+  stat_key = (plist_stat.st_mtime_ns, plist_stat.st_size)
+  with _plist_cache_lock:
+    cache_entry = _plist_cache.get(plist_file_path)
+  if cache_entry and cache_entry[0] == stat_key:
+    return cache_entry[1]
+  with open(plist_file_path, 'rb') as plist_file:
+    if not plist_stat.st_size:
+      # An empty file can not be mapped. Let plistlib raise the error.
+      plist_root_object = plistlib.load(plist_file)
+    else:
+      # Maps the file instead of reading it into a bytes object. The binary
+      # plist parser then only reads the pieces it needs from the page cache.
+      with mmap.mmap(plist_file.fileno(), 0,
+                     access=mmap.ACCESS_READ) as plist_content:
+        # Picks the parser by the binary plist magic header directly instead
+        # of letting plistlib sniff the format.
+        if plist_content[:len(_BINARY_PLIST_HEADER)] == _BINARY_PLIST_HEADER:
+          plist_format = plistlib.FMT_BINARY
+        else:
+          plist_format = plistlib.FMT_XML
+        plist_root_object = plistlib.load(plist_content, fmt=plist_format)
+  with _plist_cache_lock:
+    _plist_cache[plist_file_path] = (stat_key, plist_root_object)
+  return plist_root_object
+
+
+def _DumpPlistRootObject(plist_file_path, plist_root_object):
+  """Dumps the root object to the .plist file and refreshes the cache.
+
+  Args:
+    plist_file_path: string, the path of the .plist file.
+    plist_root_object: the root object to dump. It is owned by the cache after
+      dumping and must not be mutated.
+  """
+  # Writes through the symlinks, as writing in place does.
+  real_file_path = os.path.realpath(plist_file_path)
+  real_dir_path = os.path.dirname(real_file_path)
+  if (not os.path.exists(real_file_path) or
+      not os.access(real_dir_path, os.W_OK)):
+    # A new file has no content to protect and gets the default mode. If the
+    # directory is not writable, the file can only be written in place.
+    with open(real_file_path, 'wb') as plist_file:
       plistlib.dump(plist_root_object, plist_file)
+  else:
+    # Writes to a temp file and renames it, so the existing .plist file is
+    # never left half written.
+    fd, temp_file_path = tempfile.mkstemp(dir=real_dir_path, prefix='.plist-')
+    try:
+      with os.fdopen(fd, 'wb') as plist_file:
+        plistlib.dump(plist_root_object, plist_file)
+      shutil.copymode(real_file_path, temp_file_path)
+      os.replace(temp_file_path, real_file_path)
+    except BaseException:
+      os.remove(temp_file_path)
+      raise
+  plist_stat = os.stat(plist_file_path)
+  with _plist_cache_lock:
+    _plist_cache[plist_file_path] = (
+        (plist_stat.st_mtime_ns, plist_stat.st_size), plist_root_object)
+
+
+def _IsSameValue(target_object, parsed_key, value):
+  """Checks if the object already has the same value under the key."""
+  try:
+    current_value = target_object[parsed_key]
+  except (KeyError, IndexError):
+    return False
+  # In Python, True == 1. But they are different types in plist.
+  return type(current_value) is type(value) and current_value == value
+
+
+def _CopyIfMutable(target_object):
+  """Returns a deep copy of the object if it is dict or list."""
+  if isinstance(target_object, (dict, list)):
+    return copy.deepcopy(target_object)
+  return target_object
 
 
 def _GetObjectWithField(target_object, field):
@@ -182,6 +310,72 @@ def _GetObjectWithField(target_object, field):
   return current_object
 
 
+def _TryGetObjectWithField(target_object, field):
+  """Gets sub object of the object with field without raising error.
+
+  Args:
+    target_object: the target object.
+    field: string, the field consist of property key names delimited by
+        colons. List(array) items are specified by a zero-based integer index.
+
+  Returns:
+    a tuple of two items:
+      bool, whether the field exists in the target object.
+      the object of the target object's field or None if it does not exist.
+  """
+  if not field:
+    return True, target_object
+  current_object = target_object
+  for key in field.split(':'):
+    if isinstance(current_object, dict):
+      if key not in current_object:
+        return False, None
+      current_object = current_object[key]
+    elif isinstance(current_object, list):
+      try:
+        index = int(key)
+      except ValueError:
+        return False, None
+      if not -len(current_object) <= index < len(current_object):
+        return False, None
+      current_object = current_object[index]
+    else:
+      return False, None
+  return True, current_object
+
+
+def _GetParentObjectWithField(target_object, field):
+  """Gets the parent object of the field's last key in one traversal.
+
+  Args:
+    target_object: the target object.
+    field: string, the field consist of property key names delimited by
+        colons. List(array) items are specified by a zero-based integer index.
+        Examples
+          :CFBundleShortVersionString
+          :CFBundleDocumentTypes:2:CFBundleTypeExtensions
+
+  Returns:
+    a tuple of the parent object and the last key of the field.
+
+  Raises:
+    ios_errors.PlistError: the parent field does not exist in the object or the
+      field is invaild.
+  """
+  keys = field.split(':')
+  current_object = target_object
+  for key in keys[:-1]:
+    try:
+      current_object = current_object[_ParseKey(current_object, key)]
+    except ios_errors.PlistError as e:
+      raise e
+    except (KeyError, IndexError):
+      raise ios_errors.PlistError(
+          'The field %s can not be found in the target object. '
+          'The object content is %s' % (field, current_object))
+  return current_object, keys[-1]
+
+
 def _ParseKey(target_object, key):
   """Parses the key value according target object type.
 
@@ -196,14 +390,34 @@ def _ParseKey(target_object, key):
     ios_errors.PlistError: when object is list and key is not int, or object is
       not list/dict.
   """
-  if isinstance(target_object, dict):
-    return key
-  if isinstance(target_object, list):
-    try:
-      return int(key)
-    except ValueError:
-      raise ios_errors.PlistError(
-          'The key %s is invaild index of list(array) object %s.'
-          % (key, target_object))
-  raise ios_errors.PlistError('The object %s is not dict or list.'
-                              % target_object)
+  parse_key_function = _PARSE_KEY_FUNCTIONS.get(type(target_object))
+  if parse_key_function is None:
+    # Falls back to the subclasses of dict and list.
+    if isinstance(target_object, dict):
+      parse_key_function = _ParseDictKey
+    elif isinstance(target_object, list):
+      parse_key_function = _ParseListKey
+    else:
+      raise ios_errors.PlistError('The object %s is not dict or list.'
+                                  % target_object)
+  return parse_key_function(target_object, key)
+
+
+def _ParseDictKey(unused_target_object, key):
+  """Parses the key of dict object."""
+  return key
+
+
+def _ParseListKey(target_object, key):
+  """Parses the key of list(array) object."""
+  try:
+    return int(key)
+  except ValueError:
+    raise ios_errors.PlistError(
+        'The key %s is invaild index of list(array) object %s.'
+        % (key, target_object))
+
+
+# Dispatches _ParseKey by the exact type of the target object, which is faster
+# than isinstance checks.
+_PARSE_KEY_FUNCTIONS = {dict: _ParseDictKey, list: _ParseListKey}
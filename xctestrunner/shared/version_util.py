@@ -14,6 +14,8 @@
 
 """Utility methods for Apple version."""
 
+import functools
+
 
 def GetVersionNumber(version_str):
   """Gets the version number of the given version string."""
@@ -24,3 +26,15 @@ def GetVersionNumber(version_str):
   if len(parts) > 2:
     version_number += int(parts[2])
   return version_number
+
+
+@functools.lru_cache(maxsize=None)
+def GetMajorMinorVersion(version_str):
+  """Gets the (major, minor) tuple of the given version string."""
+  parts = version_str.split('.')
+  return int(parts[0]), int(parts[1]) if len(parts) > 1 else 0
+
+
+def FormatMajorMinorVersion(version):
+  """Formats the (major, minor) tuple to version string."""
+  return '%d.%d' % version
@@ -14,19 +14,35 @@
 
 """Utility methods for Xcode information."""
 
+import concurrent.futures
+import functools
 import os
+import re
 import subprocess
 
 from xctestrunner.shared import ios_constants
-from xctestrunner.shared import version_util
 
 
+_XCODE_VERSION_PATTERN = re.compile(r'^Xcode (\d+)(?:\.(\d+))?(?:\.(\d+))?')
+_XCODE_BUILD_VERSION_PATTERN = re.compile(r'^Build version (\S+)', re.MULTILINE)
+# Set the environment variable to 1 to run the commands in _PREFETCH_COMMANDS
+# concurrently in background when this module is imported.
+_EAGER_XCODE_ENV = 'XCTESTRUNNER_EAGER_XCODE'
+_XCODE_SELECT_COMMAND = ('xcode-select', '-p')
+_XCODEBUILD_VERSION_COMMAND = ('xcodebuild', '-version')
+_DARWIN_USER_CACHE_DIR_COMMAND = ('getconf', 'DARWIN_USER_CACHE_DIR')
+_PREFETCH_COMMANDS = (_XCODE_SELECT_COMMAND, _XCODEBUILD_VERSION_COMMAND,
+                      _DARWIN_USER_CACHE_DIR_COMMAND)
+
 _xcode_version_number = None
+# The futures of the prefetched command outputs. The key is the command.
+_prefetched_outputs = {}
 
 
+@functools.lru_cache(maxsize=None)
 def GetXcodeDeveloperPath():
   """Gets the active developer path of Xcode command line tools."""
-  return subprocess.check_output(('xcode-select', '-p')).decode('utf-8').strip()
+  return _GetCommandOutput(_XCODE_SELECT_COMMAND).strip()
 
 
 def GetXcodeVersionNumber():
@@ -41,23 +57,36 @@ def GetXcodeVersionNumber():
   if _xcode_version_number is not None:
     return _xcode_version_number
 
-  # Example output:
-  # Xcode 8.2.1
-  # Build version 8C1002
-  output = subprocess.check_output(('xcodebuild', '-version')).decode('utf-8')
-  xcode_version = output.split('\n')[0].split(' ')[1]
+  major, minor, patch = (
+      int(part) if part else 0
+      for part in _XCODE_VERSION_PATTERN.match(
+          _GetXcodebuildVersionOutput()).groups())
   # Add cache xcode_version_number to avoid calling subprocess multiple times.
   # It is expected that no one changes xcode during the test runner working.
-  _xcode_version_number = version_util.GetVersionNumber(xcode_version)
+  _xcode_version_number = major * 100 + minor * 10 + patch
   return _xcode_version_number
 
 
+def GetXcodeBuildVersion():
+  """Gets the Xcode build version.
+
+  E.g. if the output of `xcodebuild -version` contains "Build version 8C1002",
+  the xcode build version is 8C1002.
+
+  Returns:
+    string, xcode build version.
+  """
+  return _XCODE_BUILD_VERSION_PATTERN.search(
+      _GetXcodebuildVersionOutput()).group(1)
+
+
 # Xcode 11+'s Swift dylibs are configured in a way that does not allow them to
 # load the correct libswiftFoundation.dylib file from
 # libXCTestSwiftSupport.dylib. This bug only affects tests that run on fallbacks
 # to the correct Swift dylibs that have been packaged with Xcode. This method
 # returns the path to that fallback directory.
 # See https://github.com/bazelbuild/rules_apple/issues/684 for context.
+@functools.lru_cache(maxsize=None)
 def GetSwift5FallbackLibsDir():
   """Gets the Swift5 fallback libraries directory."""
   relative_path = 'Toolchains/XcodeDefault.xctoolchain/usr/lib/swift-5.0'
@@ -69,32 +98,73 @@ def GetSwift5FallbackLibsDir():
   return None
 
 
+@functools.lru_cache(maxsize=None)
 def GetSdkPlatformPath(sdk):
   """Gets the selected SDK platform path."""
-  return subprocess.check_output(
-      ['xcrun', '--sdk', sdk,
-       '--show-sdk-platform-path']).decode('utf-8').strip()
+  return subprocess.run(
+      ['xcrun', '--sdk', sdk, '--show-sdk-platform-path'], check=True,
+      stdout=subprocess.PIPE, text=True).stdout.strip()
 
 
+@functools.lru_cache(maxsize=None)
 def GetSdkVersion(sdk):
   """Gets the selected SDK version."""
-  return subprocess.check_output(['xcrun', '--sdk', sdk, '--show-sdk-version'
-                                 ]).decode('utf-8').strip()
+  return subprocess.run(
+      ['xcrun', '--sdk', sdk, '--show-sdk-version'], check=True,
+      stdout=subprocess.PIPE, text=True).stdout.strip()
 
 
+@functools.lru_cache(maxsize=None)
 def GetXctestToolPath(sdk):
   """Gets the path of xctest tool under the given SDK platform."""
   return os.path.join(
       GetSdkPlatformPath(sdk), 'Developer/Library/Xcode/Agents/xctest')
 
 
+@functools.lru_cache(maxsize=None)
 def GetDarwinUserCacheDir():
   """Gets the path of Darwin user cache directory."""
-  return subprocess.check_output(
-      ('getconf', 'DARWIN_USER_CACHE_DIR')).decode('utf-8').rstrip()
+  return _GetCommandOutput(_DARWIN_USER_CACHE_DIR_COMMAND).rstrip()
 
 
+@functools.lru_cache(maxsize=None)
 def GetXcodeEmbeddedAppDeltasDir():
   """Gets the path of Xcode's EmbeddedAppDeltas directory."""
   return os.path.join(GetDarwinUserCacheDir(),
                       'com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas')
+
+
+@functools.lru_cache(maxsize=None)
+def _GetXcodebuildVersionOutput():
+  """Gets the output of `xcodebuild -version`."""
+  # Example output:
+  # Xcode 8.2.1
+  # Build version 8C1002
+  return _GetCommandOutput(_XCODEBUILD_VERSION_COMMAND)
+
+
+def _RunCommand(command):
+  """Runs the command and returns its stdout."""
+  return subprocess.run(
+      command, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+
+def _GetCommandOutput(command):
+  """Gets the stdout of the command, reusing the prefetched output if any."""
+  future = _prefetched_outputs.pop(command, None)
+  if future is not None:
+    return future.result()
+  return _RunCommand(command)
+
+
+def _PrefetchCommandOutputs():
+  """Runs the commands in _PREFETCH_COMMANDS concurrently in background."""
+  executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=len(_PREFETCH_COMMANDS))
+  for command in _PREFETCH_COMMANDS:
+    _prefetched_outputs[command] = executor.submit(_RunCommand, command)
+  executor.shutdown(wait=False)
+
+
+if os.environ.get(_EAGER_XCODE_ENV) == '1':
+  _PrefetchCommandOutputs()
@@ -14,17 +14,46 @@
 
 """The helper class to get information from simulator device type's profile."""
 
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import json
 import os
+import re
+import tempfile
+import threading
 
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
 from xctestrunner.shared import plist_util
 from xctestrunner.shared import xcode_info_util
 
+_SIM_DEVICE_TYPE_EXTENSION = '.simdevicetype'
+_PROFILE_PLIST_PATH_FORMAT = (
+    '%s/%s' + _SIM_DEVICE_TYPE_EXTENSION + '/Contents/Resources/profile.plist')
+_OS_VERSIONS_DISK_CACHE_FILE_NAME = 'simtype_profile.json'
+_OS_VERSION_PATTERN = re.compile(r'^(\d+)(?:\.(\d+))?')
+# The sentinel of the OS versions which are not loaded yet. The max OS version
+# can be None after loading.
+_UNLOADED = object()
+
+_os_versions_disk_cache = None
+# The OS versions which are loaded in this process but not written to the disk
+# cache yet.
+_os_versions_disk_cache_updates = {}
+# The depth of _BatchOsVersionsDiskCacheWrites. The disk cache is only written
+# when it is 0.
+_os_versions_disk_cache_batch_depth = 0
+_os_versions_disk_cache_lock = threading.Lock()
+
 
 class SimTypeProfile(object):
   """The object for simulator device type's profile."""
 
+  __slots__ = ('_device_type', '_profile_plist_obj', '_min_os_version',
+               '_max_os_version')
+
   def __init__(self, device_type):
     """Constructor of SimulatorProfile object.
 
@@ -35,8 +64,21 @@ class SimTypeProfile(object):
     """
     self._device_type = device_type
     self._profile_plist_obj = None
-    self._min_os_version = None
-    self._max_os_version = None
+    self._min_os_version = _UNLOADED
+    self._max_os_version = _UNLOADED
+
+  def __eq__(self, other):
+    if not isinstance(other, SimTypeProfile):
+      return NotImplemented
+    return self._device_type == other._device_type
+
+  def __hash__(self):
+    return hash(self._device_type)
+
+  @property
+  def device_type(self):
+    """Gets the device type of the simulator."""
+    return self._device_type
 
   @property
   def profile_plist_obj(self):
@@ -46,21 +88,8 @@ class SimTypeProfile(object):
       plist_util.Plist, the Plist object of the simulator device type's
       profile.plist.
     """
-    if not self._profile_plist_obj:
-      xcode_version = xcode_info_util.GetXcodeVersionNumber()
-      platform_path = xcode_info_util.GetSdkPlatformPath(
-          ios_constants.SDK.IPHONEOS)
-      if xcode_version >= 1100:
-        sim_profiles_dir = os.path.join(
-            platform_path, 'Library/Developer/CoreSimulator/Profiles')
-      else:
-        sim_profiles_dir = os.path.join(
-            platform_path, 'Developer/Library/CoreSimulator/Profiles')
-      profile_plist_path = os.path.join(
-          sim_profiles_dir,
-          'DeviceTypes/%s.simdevicetype/Contents/Resources/profile.plist' %
-          self._device_type)
-      self._profile_plist_obj = plist_util.Plist(profile_plist_path)
+    if self._profile_plist_obj is None:
+      self._profile_plist_obj = _GetProfilePlist(self._device_type)
     return self._profile_plist_obj
 
   @property
@@ -68,12 +97,9 @@ class SimTypeProfile(object):
     """Gets the min supported OS version.
 
     Returns:
-      float, the min supported OS version.
+      tuple(int, int), the (major, minor) of the min supported OS version.
     """
-    if not self._min_os_version:
-      min_os_version_str = self.profile_plist_obj.GetPlistField(
-          'minRuntimeVersion')
-      self._min_os_version = _extra_os_version(min_os_version_str)
+    self._LoadOsVersions()
     return self._min_os_version
 
   @property
@@ -81,26 +107,300 @@ class SimTypeProfile(object):
     """Gets the max supported OS version.
 
     Returns:
-      float, the max supported OS version or None if it is not found.
+      tuple(int, int), the (major, minor) of the max supported OS version or
+      None if it is not found.
     """
-    if not self._max_os_version:
-      # If the profile.plist does not have maxRuntimeVersion field, it means
-      # it supports the max OS version of current iphonesimulator platform.
-      try:
-        max_os_version_str = self.profile_plist_obj.GetPlistField(
-            'maxRuntimeVersion')
-      except ios_errors.PlistError:
-        return None
-      self._max_os_version = _extra_os_version(max_os_version_str)
+    self._LoadOsVersions()
     return self._max_os_version
 
+  def SupportsOsVersion(self, os_version):
+    """Checks if the simulator device type supports the given OS version.
+
+    The max OS version is only checked when the given OS version is not lower
+    than the min OS version.
+
+    Args:
+      os_version: tuple(int, int), the (major, minor) of the OS version.
+
+    Returns:
+      True if the OS version is in the supported range, False otherwise.
+    """
+    if os_version < self.min_os_version:
+      return False
+    max_os_version = self.max_os_version
+    return max_os_version is None or os_version <= max_os_version
+
+  def _LoadOsVersions(self):
+    """Loads both the min and max supported OS versions at once."""
+    if self._min_os_version is not _UNLOADED:
+      return
+    disk_cache_key = _GetOsVersionsDiskCacheKey(self._device_type)
+    cached_os_versions = _ParseCachedOsVersions(
+        _GetOsVersionsDiskCache().get(disk_cache_key))
+    if cached_os_versions:
+      self._min_os_version, self._max_os_version = cached_os_versions
+      return
+
+    min_os_version_str = self.profile_plist_obj.GetPlistField(
+        'minRuntimeVersion')
+    # If the profile.plist does not have maxRuntimeVersion field, it means
+    # it supports the max OS version of current iphonesimulator platform.
+    max_os_version_str = self.profile_plist_obj.GetPlistFieldOrDefault(
+        'maxRuntimeVersion')
+    self._min_os_version = _extra_os_version(min_os_version_str)
+    self._max_os_version = (
+        _extra_os_version(max_os_version_str) if max_os_version_str else None)
+    _SaveOsVersionsToDiskCache(
+        disk_cache_key, (self._min_os_version, self._max_os_version))
+
+
+def IterSimTypeOsVersions():
+  """Iterates the supported OS versions of all simulator device types.
+
+  The device types are enumerated by a single scan of the simulator device
+  types directory of current Xcode.
+
+  Yields:
+    a tuple of three items:
+      string, the device type. E.g., iPhone 6, iPad Air, etc.
+      tuple(int, int), the min supported OS version.
+      tuple(int, int), the max supported OS version or None if it is not found.
+  """
+  with os.scandir(_GetSimDeviceTypesDir()) as entries:
+    device_types = [
+        entry.name[:-len(_SIM_DEVICE_TYPE_EXTENSION)]
+        for entry in entries
+        if entry.name.endswith(_SIM_DEVICE_TYPE_EXTENSION)
+    ]
+  os_versions = LoadSimTypesOsVersions(device_types)
+  for device_type in device_types:
+    yield (device_type,) + os_versions[device_type]
+
+
+def LoadSimTypesOsVersions(device_types):
+  """Loads the supported OS versions of the simulator device types in parallel.
+
+  It is preferred to creating SimTypeProfile one by one when the OS versions of
+  many device types are needed, because the profile.plist files are read
+  concurrently.
+
+  Args:
+    device_types: a list of string, each item is a simulator device type.
+
+  Returns:
+    a dict, the key is the device type and the value is a tuple of the min
+    supported OS version and the max supported OS version (or None).
+  """
+  device_types = list(device_types)
+  if not device_types:
+    return {}
+  # Resolves the Xcode information of the disk cache key before starting the
+  # threads, so the commands are only run once.
+  _GetOsVersionsDiskCacheKey(device_types[0])
+  with _BatchOsVersionsDiskCacheWrites():
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(32, len(device_types))) as executor:
+      return dict(
+          zip(device_types, executor.map(_LoadOsVersionsOfSimType,
+                                         device_types)))
+
+
+def _LoadOsVersionsOfSimType(device_type):
+  """Loads the min and max supported OS versions of the device type."""
+  profile = SimTypeProfile(device_type)
+  return profile.min_os_version, profile.max_os_version
+
+
+@functools.lru_cache(maxsize=None)
+def _GetSimDeviceTypesDir():
+  """Gets the simulator device types directory of current Xcode."""
+  xcode_version = xcode_info_util.GetXcodeVersionNumber()
+  platform_path = xcode_info_util.GetSdkPlatformPath(ios_constants.SDK.IPHONEOS)
+  if xcode_version >= 1100:
+    return os.path.join(platform_path,
+                        'Library/Developer/CoreSimulator/Profiles/DeviceTypes')
+  return os.path.join(platform_path,
+                      'Developer/Library/CoreSimulator/Profiles/DeviceTypes')
+
+
+@functools.lru_cache(maxsize=None)
+def _GetProfilePlist(device_type):
+  """Gets the shared Plist object of the simulator device type's profile.plist.
+
+  The simulator device types directory is fixed in the process, so the device
+  type is enough to be the cache key.
+
+  Args:
+    device_type: string, device type of the simulator.
+
+  Returns:
+    plist_util.Plist, the Plist object of the simulator device type's
+    profile.plist.
+  """
+  return plist_util.Plist(_PROFILE_PLIST_PATH_FORMAT %
+                          (_GetSimDeviceTypesDir(), device_type))
+
+
+def _GetOsVersionsDiskCacheKey(device_type):
+  """Gets the key of the device type in the OS versions disk cache.
+
+  The key contains the selected Xcode and its build version, so the cache is
+  invalidated when Xcode is switched or upgraded.
+
+  Args:
+    device_type: string, device type of the simulator.
+
+  Returns:
+    string, the key in the OS versions disk cache.
+  """
+  return '%s:%s:%s' % (xcode_info_util.GetXcodeDeveloperPath(),
+                       xcode_info_util.GetXcodeBuildVersion(), device_type)
+
+
+def _GetOsVersionsDiskCachePath():
+  """Gets the path of the OS versions disk cache file."""
+  cache_home_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+      os.path.expanduser('~'), 'Library/Caches')
+  return os.path.join(cache_home_dir, 'xctestrunner',
+                      _OS_VERSIONS_DISK_CACHE_FILE_NAME)
+
+
+def _GetOsVersionsDiskCache():
+  """Gets the OS versions disk cache which is shared by processes.
+
+  Returns:
+    a dict, the key is from _GetOsVersionsDiskCacheKey and the value is a list
+    of the min and max OS versions.
+  """
+  global _os_versions_disk_cache
+  with _os_versions_disk_cache_lock:
+    if _os_versions_disk_cache is None:
+      _os_versions_disk_cache = _ReadOsVersionsDiskCacheFile(
+          _GetOsVersionsDiskCachePath())
+    return _os_versions_disk_cache
+
+
+def _ReadOsVersionsDiskCacheFile(cache_path):
+  """Reads the OS versions disk cache file or returns {} if it is invalid."""
+  try:
+    with open(cache_path) as cache_file:
+      os_versions_disk_cache = json.load(cache_file)
+  except (OSError, ValueError):
+    return {}
+  if not isinstance(os_versions_disk_cache, dict):
+    return {}
+  return os_versions_disk_cache
+
+
+def _ParseCachedOsVersions(cached_os_versions):
+  """Parses the cached value of the min and max OS versions.
+
+  Args:
+    cached_os_versions: the value in the OS versions disk cache.
+
+  Returns:
+    a tuple of the min OS version and the max OS version (or None), or None if
+    the value is missing or malformed.
+  """
+  def _IsOsVersion(os_version):
+    return (isinstance(os_version, list) and len(os_version) == 2 and
+            all(isinstance(number, int) for number in os_version))
+
+  if (not isinstance(cached_os_versions, list) or
+      len(cached_os_versions) != 2):
+    return None
+  min_os_version, max_os_version = cached_os_versions
+  if not _IsOsVersion(min_os_version) or not (
+      max_os_version is None or _IsOsVersion(max_os_version)):
+    return None
+  return (tuple(min_os_version),
+          tuple(max_os_version) if max_os_version else None)
+
+
+@contextlib.contextmanager
+def _BatchOsVersionsDiskCacheWrites():
+  """Writes the OS versions loaded in the context to the disk cache at once."""
+  global _os_versions_disk_cache_batch_depth
+  with _os_versions_disk_cache_lock:
+    _os_versions_disk_cache_batch_depth += 1
+  try:
+    yield
+  finally:
+    with _os_versions_disk_cache_lock:
+      _os_versions_disk_cache_batch_depth -= 1
+    _FlushOsVersionsDiskCache()
+
+
+def _SaveOsVersionsToDiskCache(disk_cache_key, os_versions):
+  """Saves the min and max OS versions of a device type to the disk cache.
+
+  Inside _BatchOsVersionsDiskCacheWrites, the OS versions are only written when
+  the context exits.
+
+  Args:
+    disk_cache_key: string, the key from _GetOsVersionsDiskCacheKey.
+    os_versions: a tuple of the min OS version and the max OS version (or None).
+  """
+  os_versions_disk_cache = _GetOsVersionsDiskCache()
+  with _os_versions_disk_cache_lock:
+    os_versions_disk_cache[disk_cache_key] = os_versions
+    _os_versions_disk_cache_updates[disk_cache_key] = os_versions
+    if _os_versions_disk_cache_batch_depth:
+      return
+  _FlushOsVersionsDiskCache()
+
+
+def _FlushOsVersionsDiskCache():
+  """Merges the pending OS versions into the disk cache file.
+
+  The file is locked while it is read, merged and replaced, so the entries
+  written by other processes are kept. The entries of other build versions of
+  current Xcode are dropped.
+  """
+  with _os_versions_disk_cache_lock:
+    if not _os_versions_disk_cache_updates:
+      return
+    updates = dict(_os_versions_disk_cache_updates)
+    _os_versions_disk_cache_updates.clear()
+  cache_path = _GetOsVersionsDiskCachePath()
+  xcode_key_prefix = xcode_info_util.GetXcodeDeveloperPath() + ':'
+  build_key_prefix = '%s%s:' % (xcode_key_prefix,
+                                xcode_info_util.GetXcodeBuildVersion())
+  # The disk cache is only an optimization, so ignores the failures of
+  # writing.
+  try:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path + '.lock', 'a') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      os_versions_disk_cache = {
+          key: value for key, value in
+          _ReadOsVersionsDiskCacheFile(cache_path).items()
+          if not key.startswith(xcode_key_prefix) or
+          key.startswith(build_key_prefix)
+      }
+      os_versions_disk_cache.update(updates)
+      fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+      try:
+        with os.fdopen(fd, 'w') as cache_file:
+          json.dump(os_versions_disk_cache, cache_file)
+        os.replace(temp_file_path, cache_path)
+      finally:
+        if os.path.exists(temp_file_path):
+          os.remove(temp_file_path)
+  except OSError:
+    pass
+
 
 def _extra_os_version(os_version_str):
-  """Extracts os version float value from a given string."""
-  # Cut build version. E.g., cut 9.3.3 to 9.3.
-  if os_version_str.count('.') > 1:
-    os_version_str = os_version_str[:os_version_str.rfind('.')]
-  # We need to round the os version string in the simulator profile. E.g.,
-  # the maxRuntimeVersion of iPhone 5 is 10.255.255 and we could create iOS 10.3
+  """Extracts os version (major, minor) tuple from a given string."""
+  # Cut build version. E.g., cut 9.3.3 to (9, 3). The maxRuntimeVersion of
+  # iPhone 5 is 10.255.255 which is (10, 255), so we could create any iOS 10.x
   # for iPhone 5.
-  return round(float(os_version_str), 1)
+  # Trailing parts which are not numbers are ignored. E.g., 10.0b1 is (10, 0).
+  match = _OS_VERSION_PATTERN.match(os_version_str)
+  if not match:
+    raise ios_errors.SimError(
+        'Can not parse the OS version %s in the simulator device type profile.'
+        % os_version_str)
+  major, minor = match.groups()
+  return int(major), int(minor or 0)
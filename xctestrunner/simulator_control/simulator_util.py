@@ -13,18 +13,26 @@
 # limitations under the License.
 """The utility class for simulator."""
 
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
 import json
 import logging
 import os
+import plistlib
 import pwd
 import re
+import select
 import shutil
 import subprocess
+import tempfile
 import time
 
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
 from xctestrunner.shared import plist_util
+from xctestrunner.shared import version_util
 from xctestrunner.shared import xcode_info_util
 from xctestrunner.simulator_control import simtype_profile
 
@@ -36,11 +44,33 @@ _SIMULATOR_STATES_MAPPING = {
 _PREFIX_RUNTIME_ID = 'com.apple.CoreSimulator.SimRuntime.'
 _SIM_OPERATION_MAX_ATTEMPTS = 3
 _SIMCTL_MAX_ATTEMPTS = 2
+# Booting a simulator for the first time may take more than one minute.
+_SIMCTL_TIMEOUT_SEC = 180
 _SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC = 10
 _SIMULATOR_BOOTED_TIMEOUT_SEC = 10
 _SIMULATOR_SHUTDOWN_TIMEOUT_SEC = 30
 _SIM_ERROR_RETRY_INTERVAL_SEC = 2
 _SIM_CHECK_STATE_INTERVAL_SEC = 0.5
+# The max time of waiting for a change of device.plist before checking the
+# state again, in case the change is missed by kqueue.
+_SIM_WATCH_STATE_MAX_WAIT_SEC = 4 * _SIM_CHECK_STATE_INTERVAL_SEC
+# Opens the file only for the event notifications.
+_O_EVTONLY = getattr(os, 'O_EVTONLY', os.O_RDONLY)
+# If the environment variable is set to 1, the simulators created by
+# CreateNewSimulator are erased and kept in a pool when they are deleted, and
+# CreateNewSimulator reuses them instead of creating new ones. The pool is
+# shared by processes through the names of the simulators.
+_SIM_POOL_ENV = 'XCTESTRUNNER_SIM_POOL'
+_SIM_POOL_NAME_PREFIX = 'xctestrunner-pool'
+# The environment variable of the max number of pooled simulators of each
+# device type and OS version.
+_SIM_POOL_SIZE_ENV = 'XCTESTRUNNER_SIM_POOL_SIZE'
+_DEFAULT_SIM_POOL_SIZE = 2
+_SIM_POOL_LOCK_FILE_NAME = 'xctestrunner_sim_pool.lock'
+# The name of the simulator which is being erased before joining the pool is
+# the pool name, this infix and the pid of the process which reserves the
+# slot. So the slot is reclaimed after the process dies.
+_SIM_POOL_RESERVED_NAME_INFIX = '-reserved-'
 _PATTERN_APP_CRASH_ON_SIM = (
     r'com\.apple\.CoreSimulator\.SimDevice\.[A-Z0-9\-]+(.+) '
     r'\(UIKitApplication:%s(.+)\): Service exited '
@@ -52,11 +82,25 @@ _PATTERN_XCTEST_PROCESS_CRASH_ON_SIM = (
 _PATTERN_CORESIMULATOR_CRASH = (
     r'com\.apple\.CoreSimulator\.SimDevice\.[A-Z0-9\-]+(.+) '
     r'\(com\.apple\.CoreSimulator(.+)\): Service exited due to ')
+_XCTEST_PROCESS_CRASH_ON_SIM_RE = re.compile(
+    _PATTERN_XCTEST_PROCESS_CRASH_ON_SIM)
+_CORESIMULATOR_CRASH_RE = re.compile(_PATTERN_CORESIMULATOR_CRASH)
+
+
+# The (device type, OS version) of the simulators which are created by
+# CreateNewSimulator in this process. Only these simulators can be released to
+# the pool.
+_created_simulator_keys = {}
+_sim_pool_disabled = False
 
 
 class Simulator(object):
   """The object for simulator in MacOS."""
 
+  __slots__ = ('_simulator_id', '_simulator_root_dir',
+               '_simulator_log_root_dir', '_simulator_system_log_path',
+               '_device_plist_object', '_device_plist_state')
+
   def __init__(self, simulator_id):
     """Constructor of Simulator object.
 
@@ -66,7 +110,11 @@ class Simulator(object):
     self._simulator_id = simulator_id
     self._simulator_root_dir = None
     self._simulator_log_root_dir = None
+    self._simulator_system_log_path = None
     self._device_plist_object = None
+    # The tuple of the (st_mtime_ns, st_size) of device.plist and the state
+    # number read from it.
+    self._device_plist_state = None
 
   @property
   def simulator_id(self):
@@ -77,13 +125,16 @@ class Simulator(object):
 
   @property
   def simulator_system_log_path(self):
-    return os.path.join(self.simulator_log_root_dir, 'system.log')
+    if not self._simulator_system_log_path:
+      self._simulator_system_log_path = os.path.join(
+          self.simulator_log_root_dir, 'system.log')
+    return self._simulator_system_log_path
 
   @property
   def simulator_root_dir(self):
     """Gets the simulator's root directory."""
     if not self._simulator_root_dir:
-      home_dir = pwd.getpwuid(os.geteuid()).pw_dir
+      home_dir = _GetHomeDir()
       self._simulator_root_dir = os.path.join(
           '%s/Library/Developer/CoreSimulator/Devices/%s' %
           (home_dir, self.simulator_id))
@@ -93,7 +144,7 @@ class Simulator(object):
   def simulator_log_root_dir(self):
     """Gets the root directory of the simulator's logs."""
     if not self._simulator_log_root_dir:
-      home_dir = pwd.getpwuid(os.geteuid()).pw_dir
+      home_dir = _GetHomeDir()
       self._simulator_log_root_dir = os.path.join(
           '%s/Library/Logs/CoreSimulator/%s' % (home_dir, self.simulator_id))
     return self._simulator_log_root_dir
@@ -160,7 +211,10 @@ class Simulator(object):
     """Deletes the simulator.
 
     The simulator state should be SHUTDOWN when deleting it. Otherwise, it will
-    raise exception.
+    raise exception. If the simulator pool is enabled, the simulator created by
+    CreateNewSimulator is erased and kept in the pool instead. Releasing the
+    simulator to the pool always blocks until it is shut down and erased, even
+    if asynchronously is True.
 
     Args:
       asynchronously: whether deleting the simulator asynchronously.
@@ -168,13 +222,17 @@ class Simulator(object):
       ios_errors.SimError: The simulator's state is not SHUTDOWN.
     """
     command = ['xcrun', 'simctl', 'delete', self.simulator_id]
-    if asynchronously:
+    if _IsSimPoolEnabled() and self._ReleaseToPool():
+      logging.info('Released simulator %s to the pool.', self.simulator_id)
+    elif asynchronously:
       logging.info('Deleting simulator %s asynchronously.', self.simulator_id)
+      # The output is never read, so it must not go to pipes which may fill
+      # up. preexec_fn is not safe when the test shards run in threads.
       subprocess.Popen(
           command,
-          stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE,
-          preexec_fn=os.setpgrp)
+          stdout=subprocess.DEVNULL,
+          stderr=subprocess.DEVNULL,
+          start_new_session=True)
     else:
       try:
         RunSimctlCommand(command)
@@ -184,8 +242,60 @@ class Simulator(object):
                                   (self.simulator_id, str(e)))
     # The delete command won't delete the simulator log directory.
     if os.path.exists(self.simulator_log_root_dir):
-      shutil.rmtree(self.simulator_log_root_dir, ignore_errors=True)
+      if asynchronously:
+        subprocess.Popen(['rm', '-rf', self.simulator_log_root_dir],
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+      else:
+        shutil.rmtree(self.simulator_log_root_dir, ignore_errors=True)
     self._simulator_id = None
+    self._device_plist_state = None
+
+  def _ReleaseToPool(self):
+    """Erases the simulator and keeps it in the pool.
+
+    Returns:
+      True if the simulator is released to the pool. False if the simulator is
+      not created by CreateNewSimulator, the pool is full or it fails to erase
+      the simulator.
+    """
+    pool_key = _created_simulator_keys.get(self.simulator_id)
+    if not pool_key:
+      return False
+    device_type, os_version = pool_key
+    pool_name = _GetSimPoolName(device_type, os_version)
+    try:
+      # Reserves the slot in the pool first, so the simulator is not shut down
+      # and erased for nothing when the pool is full.
+      with _SimPoolLock():
+        if _CountSimPoolSlots(device_type, os_version) >= _GetSimPoolSize():
+          return False
+        RunSimctlCommand([
+            'xcrun', 'simctl', 'rename', self.simulator_id,
+            '%s%s%d' % (pool_name, _SIM_POOL_RESERVED_NAME_INFIX, os.getpid())
+        ])
+      try:
+        self.Shutdown()
+        RunSimctlCommand(['xcrun', 'simctl', 'erase', self.simulator_id])
+        RunSimctlCommand(
+            ['xcrun', 'simctl', 'rename', self.simulator_id, pool_name])
+      except ios_errors.SimError:
+        # The caller deletes the simulator, which frees the reserved slot.
+        raise
+      except BaseException:
+        # Frees the reserved slot before the exception leaves Delete.
+        subprocess.Popen(['xcrun', 'simctl', 'delete', self.simulator_id],
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+        raise
+    except ios_errors.SimError as e:
+      logging.warning('Failed to release simulator %s to the pool: %s',
+                      self.simulator_id, e)
+      return False
+    del _created_simulator_keys[self.simulator_id]
+    return True
 
   def FetchLogToFile(self, output_file_path, start_time=None, end_time=None):
     """Gets simulator log via running `log` tool on simulator.
@@ -223,20 +333,6 @@ class Simulator(object):
           'Failed to get data container of the app %s in simulator %s: %s' %
           (app_bundle_id, self._simulator_id, str(e)))
 
-    apps_dir = os.path.join(self.simulator_root_dir,
-                            'data/Containers/Data/Application')
-    for sub_dir_name in os.listdir(apps_dir):
-      container_manager_plist = plist_util.Plist(
-          os.path.join(apps_dir, sub_dir_name,
-                       '.com.apple.mobile_container_manager.metadata.plist'))
-      current_app_bundle_id = container_manager_plist.GetPlistField(
-          'MCMMetadataIdentifier')
-      if current_app_bundle_id == app_bundle_id:
-        return os.path.join(apps_dir, sub_dir_name, 'Documents')
-    raise ios_errors.SimError(
-        'Failed to get Documents directory of the app %s in simulator %s' %
-        (app_bundle_id, self._simulator_id))
-
   def IsAppInstalled(self, app_bundle_id):
     """Checks if the simulator has installed the app with given bundle id."""
     try:
@@ -259,11 +355,8 @@ class Simulator(object):
       ios_errors.SimError: when it is timeout to wait the simulator state
           becomes BOOTED.
     """
-    start_time = time.time()
-    while start_time + timeout_sec >= time.time():
-      time.sleep(_SIM_CHECK_STATE_INTERVAL_SEC)
-      if self.GetSimulatorState() == ios_constants.SimState.BOOTED:
-        return
+    if self._WaitUntilState(ios_constants.SimState.BOOTED, timeout_sec):
+      return
     raise ios_errors.SimError('Timeout to wait for simulator booted in %ss.' %
                               timeout_sec)
 
@@ -278,14 +371,79 @@ class Simulator(object):
       ios_errors.SimError: when it is timeout to wait the simulator state
           becomes SHUTDOWN.
     """
-    start_time = time.time()
-    while start_time + timeout_sec >= time.time():
-      time.sleep(_SIM_CHECK_STATE_INTERVAL_SEC)
-      if self.GetSimulatorState() == ios_constants.SimState.SHUTDOWN:
-        return
+    if self._WaitUntilState(ios_constants.SimState.SHUTDOWN, timeout_sec):
+      return
     raise ios_errors.SimError('Timeout to wait for simulator shutdown in %ss.' %
                               timeout_sec)
 
+  def _WaitUntilState(self, target_state, timeout_sec):
+    """Waits until the simulator state becomes the target state.
+
+    The device.plist of the simulator is watched by kqueue, so the state is
+    checked again soon after the file changes, and at least every
+    _SIM_WATCH_STATE_MAX_WAIT_SEC in case the change is missed. If kqueue is
+    not available or the device.plist does not exist yet (CREATING state), the
+    state is polled.
+
+    Args:
+      target_state: shared.ios_constants.SimState, the target state.
+      timeout_sec: int, timeout of waiting in seconds.
+
+    Returns:
+      True if the simulator state becomes the target state before timeout.
+    """
+    deadline = time.monotonic() + timeout_sec
+    while True:
+      device_plist_watcher = self._WatchDevicePlist()
+      try:
+        # Checks the state after the watcher is registered, so the change
+        # between checking and waiting will not be missed.
+        if self.GetSimulatorState() == target_state:
+          return True
+        remaining_sec = deadline - time.monotonic()
+        if remaining_sec <= 0:
+          return False
+        if device_plist_watcher:
+          device_plist_watcher[0].control(
+              None, 1, min(remaining_sec, _SIM_WATCH_STATE_MAX_WAIT_SEC))
+        else:
+          time.sleep(min(remaining_sec, _SIM_CHECK_STATE_INTERVAL_SEC))
+      finally:
+        if device_plist_watcher:
+          kq, fd = device_plist_watcher
+          kq.close()
+          os.close(fd)
+
+  def _WatchDevicePlist(self):
+    """Registers a kqueue watcher for the changes of device.plist.
+
+    Returns:
+      a tuple of the select.kqueue object and the file descriptor of the
+      device.plist, or None if the device.plist can not be watched.
+    """
+    if not hasattr(select, 'kqueue'):
+      return None
+    device_plist_path = os.path.join(self.simulator_root_dir, 'device.plist')
+    try:
+      fd = os.open(device_plist_path, _O_EVTONLY)
+    except OSError:
+      return None
+    kq = select.kqueue()
+    try:
+      kq.control([
+          select.kevent(
+              fd,
+              filter=select.KQ_FILTER_VNODE,
+              flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+              fflags=(select.KQ_NOTE_WRITE | select.KQ_NOTE_DELETE |
+                      select.KQ_NOTE_RENAME))
+      ], 0, 0)
+    except OSError:
+      kq.close()
+      os.close(fd)
+      return None
+    return kq, fd
+
   def GetSimulatorState(self):
     """Gets the state of the simulator in real time.
 
@@ -295,14 +453,28 @@ class Simulator(object):
     Raises:
       ios_errors.SimError: The state can not be recognized.
     """
-    if self.device_plist_object is None:
+    device_plist_path = os.path.join(self.simulator_root_dir, 'device.plist')
+    try:
+      device_plist_stat = os.stat(device_plist_path)
+    except FileNotFoundError:
       return ios_constants.SimState.CREATING
-    state_num = self.device_plist_object.GetPlistField('state')
-    if state_num not in _SIMULATOR_STATES_MAPPING.keys():
+    stat_key = (device_plist_stat.st_mtime_ns, device_plist_stat.st_size)
+    # Only reads the device.plist again after it changes.
+    if self._device_plist_state and self._device_plist_state[0] == stat_key:
+      state_num = self._device_plist_state[1]
+    else:
+      try:
+        with open(device_plist_path, 'rb') as device_plist_file:
+          state_num = plistlib.load(device_plist_file).get('state')
+      except FileNotFoundError:
+        return ios_constants.SimState.CREATING
+      self._device_plist_state = (stat_key, state_num)
+    sim_state = _SIMULATOR_STATES_MAPPING.get(state_num)
+    if sim_state is None:
       logging.warning('The state %s of simulator %s can not be recognized.',
                       state_num, self.simulator_id)
       return ios_constants.SimState.UNKNOWN
-    return _SIMULATOR_STATES_MAPPING[state_num]
+    return sim_state
 
 
 def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
@@ -339,23 +511,8 @@ def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
     ios_errors.SimError: when failed to create new simulator.
     ios_errors.IllegalArgumentError: when the given argument is invalid.
   """
-  if not device_type:
-    os_type = ios_constants.OS.IOS
-  else:
-    _ValidateSimulatorType(device_type)
-    os_type = GetOsType(device_type)
-  if not os_version:
-    os_version = GetLastSupportedSimOsVersion(os_type, device_type=device_type)
-  else:
-    supported_sim_os_versions = GetSupportedSimOsVersions(os_type)
-    if os_version not in supported_sim_os_versions:
-      raise ios_errors.IllegalArgumentError(
-          'The simulator os version %s is not supported. Supported simulator '
-          'os versions are %s.' % (os_version, supported_sim_os_versions))
-  if not device_type:
-    device_type = GetLastSupportedIphoneSimType(os_version)
-  else:
-    _ValidateSimulatorTypeWithOsVersion(device_type, os_version)
+  device_type, os_version, os_type = _ResolveSimulatorArgs(
+      device_type, os_version)
   if not name_prefix:
     name_prefix = 'New'
   name = '%s-%s-%s' % (name_prefix, device_type, os_version)
@@ -363,6 +520,13 @@ def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
   # Example
   # Runtime ID of iOS 10.2: com.apple.CoreSimulator.SimRuntime.iOS-10-2
   runtime_id = _PREFIX_RUNTIME_ID + os_type + '-' + os_version.replace('.', '-')
+  if _IsSimPoolEnabled():
+    pooled_simulator_id = _AcquireSimulatorFromPool(device_type, os_version,
+                                                    name)
+    if pooled_simulator_id:
+      _created_simulator_keys[pooled_simulator_id] = (device_type, os_version)
+      logging.info('Reused simulator %s from the pool.', pooled_simulator_id)
+      return pooled_simulator_id, device_type, os_version, name
   logging.info('Creating a new simulator:\nName: %s\nOS: %s %s\nType: %s', name,
                os_type, os_version, device_type)
   for i in range(0, _SIM_OPERATION_MAX_ATTEMPTS):
@@ -378,6 +542,7 @@ def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
       new_simulator_obj.WaitUntilStateShutdown(
           _SIMULATOR_CREATING_TO_SHUTDOWN_TIMEOUT_SEC)
       logging.info('Created new simulator %s.', new_simulator_id)
+      _created_simulator_keys[new_simulator_id] = (device_type, os_version)
       return new_simulator_id, device_type, os_version, name
     except ios_errors.SimError as error:
       logging.debug('Failed to create simulator %s: %s.', new_simulator_id,
@@ -395,6 +560,134 @@ def CreateNewSimulator(device_type=None, os_version=None, name_prefix=None):
                             _SIM_OPERATION_MAX_ATTEMPTS)
 
 
+def DisableSimPool():
+  """Disables the simulator pool in this process even if the env var is set."""
+  global _sim_pool_disabled
+  _sim_pool_disabled = True
+
+
+def _IsSimPoolEnabled():
+  """Checks whether the simulator pool is enabled."""
+  return not _sim_pool_disabled and os.environ.get(_SIM_POOL_ENV) == '1'
+
+
+def _GetSimPoolSize():
+  """Gets the max number of pooled simulators of device type and OS version."""
+  try:
+    return int(os.environ.get(_SIM_POOL_SIZE_ENV, _DEFAULT_SIM_POOL_SIZE))
+  except ValueError:
+    logging.warning('The value of %s should be an integer.', _SIM_POOL_SIZE_ENV)
+    return _DEFAULT_SIM_POOL_SIZE
+
+
+def _GetSimPoolName(device_type, os_version):
+  """Gets the name of the pooled simulators of device type and OS version."""
+  return '%s-%s-%s' % (_SIM_POOL_NAME_PREFIX, device_type, os_version)
+
+
+@contextlib.contextmanager
+def _SimPoolLock():
+  """Locks the simulator pool which is shared by processes."""
+  lock_file_path = os.path.join(tempfile.gettempdir(), _SIM_POOL_LOCK_FILE_NAME)
+  with open(lock_file_path, 'a') as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _ListPooledSimulatorIds(device_type, os_version):
+  """Lists the ids of the pooled simulators of device type and OS version."""
+  devices_json = _RunSimctlJsonCommand(('xcrun', 'simctl', 'list', 'devices',
+                                        '-j'))
+  pool_name = _GetSimPoolName(device_type, os_version)
+  pooled_simulator_ids = []
+  for devices in devices_json['devices'].values():
+    for device in devices:
+      if (device['name'] == pool_name and device.get('state') == 'Shutdown' and
+          device.get('isAvailable', True)):
+        pooled_simulator_ids.append(device['udid'])
+  return pooled_simulator_ids
+
+
+def _CountSimPoolSlots(device_type, os_version):
+  """Counts the pooled and reserved simulators of device type and OS version.
+
+  The simulators reserved by dead processes are deleted and not counted. It
+  should be called with _SimPoolLock.
+
+  Args:
+    device_type: string, device type of the simulator.
+    os_version: string, OS version of the simulator.
+
+  Returns:
+    int, the number of the used slots in the pool.
+  """
+  devices_json = _RunSimctlJsonCommand(('xcrun', 'simctl', 'list', 'devices',
+                                        '-j'))
+  pool_name = _GetSimPoolName(device_type, os_version)
+  reserved_name_re = re.compile(
+      re.escape(pool_name + _SIM_POOL_RESERVED_NAME_INFIX) + r'(\d+)$')
+  slot_count = 0
+  for devices in devices_json['devices'].values():
+    for device in devices:
+      if not device.get('isAvailable', True):
+        continue
+      if device['name'] == pool_name:
+        slot_count += 1
+        continue
+      match = reserved_name_re.match(device['name'])
+      if not match:
+        continue
+      if _IsProcessAlive(int(match.group(1))):
+        slot_count += 1
+      else:
+        logging.info('Deleting simulator %s reserved by a dead process.',
+                     device['udid'])
+        subprocess.Popen(['xcrun', 'simctl', 'delete', device['udid']],
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+  return slot_count
+
+
+def _IsProcessAlive(pid):
+  """Checks whether the process of pid is alive."""
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    # The process exists but belongs to another user.
+    return True
+  return True
+
+
+def _AcquireSimulatorFromPool(device_type, os_version, name):
+  """Takes a simulator of device type and OS version from the pool.
+
+  Args:
+    device_type: string, device type of the simulator.
+    os_version: string, OS version of the simulator.
+    name: string, the new name of the simulator.
+
+  Returns:
+    string, the id of the simulator or None if there is no pooled simulator.
+  """
+  try:
+    with _SimPoolLock():
+      pooled_simulator_ids = _ListPooledSimulatorIds(device_type, os_version)
+      if not pooled_simulator_ids:
+        return None
+      simulator_id = pooled_simulator_ids[0]
+      RunSimctlCommand(['xcrun', 'simctl', 'rename', simulator_id, name])
+  except ios_errors.SimError as e:
+    logging.warning('Failed to acquire simulator from the pool: %s', e)
+    return None
+  return simulator_id
+
+
 def GetSupportedSimDeviceTypes(os_type=None):
   """Gets the name list of supported simulator device types of given OS type.
 
@@ -412,6 +705,21 @@ def GetSupportedSimDeviceTypes(os_type=None):
     a list of string, each item is a simulator device type.
     E.g., ["iPhone 5", "iPhone 6 Plus"]
   """
+  sim_types = _GetAllSimDeviceTypes()
+  if os_type is None:
+    return list(sim_types)
+  if os_type == ios_constants.OS.IOS:
+    return [sim_type for sim_type in sim_types if sim_type.startswith('i')]
+  if os_type == ios_constants.OS.TVOS:
+    return [sim_type for sim_type in sim_types if 'TV' in sim_type]
+  if os_type == ios_constants.OS.WATCHOS:
+    return [sim_type for sim_type in sim_types if 'Watch' in sim_type]
+  return []
+
+
+@functools.lru_cache(maxsize=None)
+def _GetAllSimDeviceTypes():
+  """Gets the cached tuple of all simulator device types."""
   # Example output:
   # {
   #   "devicetypes" : [
@@ -423,17 +731,10 @@ def GetSupportedSimDeviceTypes(os_type=None):
   # }
   #
   # See more examples in testdata/simctl_list_devicetypes.json
-  sim_types_infos_json = json.loads(
-      RunSimctlCommand(('xcrun', 'simctl', 'list', 'devicetypes', '-j')))
-  sim_types = []
-  for sim_types_info in sim_types_infos_json['devicetypes']:
-    sim_type = sim_types_info['name']
-    if (os_type is None or
-        (os_type == ios_constants.OS.IOS and sim_type.startswith('i')) or
-        (os_type == ios_constants.OS.TVOS and 'TV' in sim_type) or
-        (os_type == ios_constants.OS.WATCHOS and 'Watch' in sim_type)):
-      sim_types.append(sim_type)
-  return sim_types
+  sim_types_infos_json = _RunSimctlJsonCommand(
+      ('xcrun', 'simctl', 'list', 'devicetypes', '-j'))
+  return tuple(sim_types_info['name']
+               for sim_types_info in sim_types_infos_json['devicetypes'])
 
 
 def GetLastSupportedIphoneSimType(os_version):
@@ -454,11 +755,11 @@ def GetLastSupportedIphoneSimType(os_version):
   """
   supported_sim_types = GetSupportedSimDeviceTypes(ios_constants.OS.IOS)
   supported_sim_types.reverse()
-  os_version_float = float(os_version)
+  os_version_tuple = version_util.GetMajorMinorVersion(os_version)
   for sim_type in supported_sim_types:
     if sim_type.startswith('iPhone'):
-      min_os_version = simtype_profile.SimTypeProfile(sim_type).min_os_version
-      if os_version_float >= min_os_version:
+      min_os_version = _GetSimTypeProfile(sim_type).min_os_version
+      if os_version_tuple >= min_os_version:
         return sim_type
   raise ios_errors.SimError('Can not find supported iPhone simulator type.')
 
@@ -473,6 +774,12 @@ def GetSupportedSimOsVersions(os_type=ios_constants.OS.IOS):
   Returns:
     a list of string, each item is an OS version number. E.g., ["10.1", "11.0"]
   """
+  return list(_GetSupportedSimOsVersions(os_type))
+
+
+@functools.lru_cache(maxsize=None)
+def _GetSupportedSimOsVersions(os_type):
+  """Gets the cached tuple of supported simulator OS versions of OS type."""
   if os_type is None:
     os_type = ios_constants.OS.IOS
   # Example output:
@@ -493,44 +800,45 @@ def GetSupportedSimOsVersions(os_type=ios_constants.OS.IOS):
   # }
   # See more examples in testdata/simctl_list_runtimes.json
   xcode_version_num = xcode_info_util.GetXcodeVersionNumber()
-  sim_runtime_infos_json = json.loads(
-      RunSimctlCommand(('xcrun', 'simctl', 'list', 'runtimes', '-j')))
+  sim_runtime_infos_json = _RunSimctlJsonCommand(
+      ('xcrun', 'simctl', 'list', 'runtimes', '-j'))
   sim_versions = []
   for sim_runtime_info in sim_runtime_infos_json['runtimes']:
-    # Normally, the json does not contain unavailable runtimes. To be safe,
-    # also checks the 'availability' field.
-    if 'availability' in sim_runtime_info and sim_runtime_info[
-        'availability'].find('unavailable') >= 0:
+    listed_os_type, _, listed_os_version = sim_runtime_info['name'].partition(
+        ' ')
+    if listed_os_type != os_type or _IsSimRuntimeUnavailable(sim_runtime_info):
       continue
-    elif 'isAvailable' in sim_runtime_info and not sim_runtime_info[
-        'isAvailable']:
-      continue
-
-    listed_os_type, listed_os_version = sim_runtime_info['name'].split(' ', 1)
-    if listed_os_type == os_type:
-      # `bundlePath` key may not exist in the old Xcode/macOS version.
-      if 'bundlePath' in sim_runtime_info:
-        runtime_path = sim_runtime_info['bundlePath']
-        info_plist_object = plist_util.Plist(
-            os.path.join(runtime_path, 'Contents/Info.plist'))
-        min_xcode_version_num = int(info_plist_object.GetPlistField('DTXcode'))
-        if xcode_version_num >= min_xcode_version_num:
-          sim_versions.append(listed_os_version)
-      else:
-        if os_type == ios_constants.OS.IOS:
-          ios_major_version, ios_minor_version = listed_os_version.split('.', 1)
-          # Ingores the potential build version
-          ios_minor_version = ios_minor_version[0]
-          ios_version_num = int(ios_major_version) * 100 + int(
-              ios_minor_version) * 10
-          # One Xcode version always maps to one max simulator's iOS version.
-          # The rules is almost max_sim_ios_version <= xcode_version + 200.
-          # E.g., Xcode 8.3.1/8.3.3 maps to iOS 10.3, Xcode 7.3.1 maps to iOS
-          # 9.3.
-          if ios_version_num > xcode_version_num + 200:
-            continue
+    # `bundlePath` key may not exist in the old Xcode/macOS version.
+    if 'bundlePath' in sim_runtime_info:
+      runtime_path = sim_runtime_info['bundlePath']
+      info_plist_object = plist_util.Plist(
+          os.path.join(runtime_path, 'Contents/Info.plist'))
+      min_xcode_version_num = int(info_plist_object.GetPlistField('DTXcode'))
+      if xcode_version_num >= min_xcode_version_num:
         sim_versions.append(listed_os_version)
-  return sim_versions
+    else:
+      if os_type == ios_constants.OS.IOS:
+        ios_major_version, ios_minor_version = listed_os_version.split('.', 1)
+        # Ingores the potential build version
+        ios_minor_version = ios_minor_version[0]
+        ios_version_num = int(ios_major_version) * 100 + int(
+            ios_minor_version) * 10
+        # One Xcode version always maps to one max simulator's iOS version.
+        # The rules is almost max_sim_ios_version <= xcode_version + 200.
+        # E.g., Xcode 8.3.1/8.3.3 maps to iOS 10.3, Xcode 7.3.1 maps to iOS
+        # 9.3.
+        if ios_version_num > xcode_version_num + 200:
+          continue
+      sim_versions.append(listed_os_version)
+  return tuple(sim_versions)
+
+
+def _IsSimRuntimeUnavailable(sim_runtime_info):
+  """Checks if the runtime info of `simctl list runtimes` is unavailable."""
+  # Normally, the json does not contain unavailable runtimes. To be safe,
+  # also checks the 'availability' field.
+  return ('unavailable' in sim_runtime_info.get('availability', '') or
+          not sim_runtime_info.get('isAvailable', True))
 
 
 def GetLastSupportedSimOsVersion(os_type=ios_constants.OS.IOS,
@@ -563,19 +871,20 @@ def GetLastSupportedSimOsVersion(os_type=ios_constants.OS.IOS,
   if not device_type:
     return supported_os_versions[-1]
 
-  max_os_version = simtype_profile.SimTypeProfile(device_type).max_os_version
+  max_os_version = _GetSimTypeProfile(device_type).max_os_version
   # The supported os versions will be from latest to older after reverse().
   supported_os_versions.reverse()
   if not max_os_version:
     return supported_os_versions[0]
 
   for os_version in supported_os_versions:
-    if float(os_version) <= max_os_version:
+    if version_util.GetMajorMinorVersion(os_version) <= max_os_version:
       return os_version
   raise ios_errors.IllegalArgumentError(
       'The supported OS version %s can not match simulator type %s. Because '
       'its max OS version is %s' %
-      (supported_os_versions, device_type, max_os_version))
+      (supported_os_versions, device_type,
+       version_util.FormatMajorMinorVersion(max_os_version)))
 
 
 def GetOsType(device_type):
@@ -608,6 +917,79 @@ def GetOsType(device_type):
       device_type)
 
 
+def _ResolveSimulatorArgs(device_type, os_version):
+  """Validates and resolves the arguments of the new simulator in one pass.
+
+  The simctl listings and the simulator type profile are loaded at most once.
+  The missing arguments are resolved as described in CreateNewSimulator.
+
+  Args:
+    device_type: string, device type of the new simulator or None.
+    os_version: string, OS version of the new simulator or None.
+
+  Returns:
+    a tuple with three items:
+      string, simulator device type of the new simulator.
+      string, OS version of the new simulator.
+      shared.ios_constants.OS, OS type of the new simulator.
+
+  Raises:
+    ios_errors.SimError: when there is no supported simulator type or OS
+        version.
+    ios_errors.IllegalArgumentError: when the given argument is invalid.
+  """
+  _PrefetchSimctlListings(device_type)
+  if not device_type:
+    os_type = ios_constants.OS.IOS
+  else:
+    _ValidateSimulatorType(device_type)
+    os_type = GetOsType(device_type)
+  if not os_version:
+    os_version = GetLastSupportedSimOsVersion(os_type, device_type=device_type)
+  else:
+    supported_sim_os_versions = GetSupportedSimOsVersions(os_type)
+    if os_version not in supported_sim_os_versions:
+      raise ios_errors.IllegalArgumentError(
+          'The simulator os version %s is not supported. Supported simulator '
+          'os versions are %s.' % (os_version, supported_sim_os_versions))
+  if not device_type:
+    device_type = GetLastSupportedIphoneSimType(os_version)
+  else:
+    _ValidateSimulatorTypeWithOsVersion(device_type, os_version)
+  return device_type, os_version, os_type
+
+
+def _PrefetchSimctlListings(device_type):
+  """Loads the simctl device type and runtime listings concurrently.
+
+  The listings are independent `xcrun simctl list` commands, so running them
+  in parallel threads saves the wall time of one command. The results are kept
+  in the caches of _GetAllSimDeviceTypes and _GetSupportedSimOsVersions.
+
+  Args:
+    device_type: string, device type of the new simulator or None.
+  """
+  # The simulators created in one process usually share the OS type, so the
+  # listings are not fetched again once both caches are filled.
+  if (_GetAllSimDeviceTypes.cache_info().currsize and
+      _GetSupportedSimOsVersions.cache_info().currsize):
+    return
+  if not device_type:
+    os_type = ios_constants.OS.IOS
+  else:
+    try:
+      os_type = GetOsType(device_type)
+    except ios_errors.IllegalArgumentError:
+      # The invalid device type will be reported by the validation.
+      os_type = None
+  # The errors are raised again by the callers of the listings, so the results
+  # of the futures are ignored here.
+  with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    executor.submit(_GetAllSimDeviceTypes)
+    if os_type:
+      executor.submit(_GetSupportedSimOsVersions, os_type)
+
+
 def _ValidateSimulatorType(device_type):
   """Checks if the simulator type is valid.
 
@@ -641,19 +1023,21 @@ def _ValidateSimulatorTypeWithOsVersion(device_type, os_version):
     ios_errors.IllegalArgumentError: when the given simulator device type can
         not match the given OS version.
   """
-  os_version_float = float(os_version)
-  sim_profile = simtype_profile.SimTypeProfile(device_type)
+  os_version_tuple = version_util.GetMajorMinorVersion(os_version)
+  sim_profile = _GetSimTypeProfile(device_type)
+  if sim_profile.SupportsOsVersion(os_version_tuple):
+    return
   min_os_version = sim_profile.min_os_version
-  if min_os_version > os_version_float:
+  if min_os_version > os_version_tuple:
     raise ios_errors.IllegalArgumentError(
-        'The min OS version of %s is %f. But current OS version is %s' %
-        (device_type, min_os_version, os_version))
+        'The min OS version of %s is %s. But current OS version is %s' %
+        (device_type, version_util.FormatMajorMinorVersion(min_os_version),
+         os_version))
   max_os_version = sim_profile.max_os_version
-  if max_os_version:
-    if max_os_version < os_version_float:
-      raise ios_errors.IllegalArgumentError(
-          'The max OS version of %s is %f. But current OS version is %s' %
-          (device_type, max_os_version, os_version))
+  raise ios_errors.IllegalArgumentError(
+      'The max OS version of %s is %s. But current OS version is %s' %
+      (device_type, version_util.FormatMajorMinorVersion(max_os_version),
+       os_version))
 
 
 def QuitSimulatorApp():
@@ -676,7 +1060,7 @@ def IsAppFailedToLaunchOnSim(sim_sys_log, app_bundle_id=''):
   Returns:
     True if the app failed to launch on simulator.
   """
-  pattern = re.compile(_PATTERN_APP_CRASH_ON_SIM % app_bundle_id)
+  pattern = _GetAppCrashOnSimRe(app_bundle_id)
   return pattern.search(sim_sys_log) is not None
 
 
@@ -689,8 +1073,7 @@ def IsXctestFailedToLaunchOnSim(sim_sys_log):
   Returns:
     True if the xctest process failed to launch on simulator.
   """
-  pattern = re.compile(_PATTERN_XCTEST_PROCESS_CRASH_ON_SIM)
-  return pattern.search(sim_sys_log) is not None
+  return _XCTEST_PROCESS_CRASH_ON_SIM_RE.search(sim_sys_log) is not None
 
 
 def IsCoreSimulatorCrash(sim_sys_log):
@@ -702,24 +1085,73 @@ def IsCoreSimulatorCrash(sim_sys_log):
   Returns:
     True if the CoreSimulator crashes.
   """
-  pattern = re.compile(_PATTERN_CORESIMULATOR_CRASH)
-  return pattern.search(sim_sys_log) is not None
+  return _CORESIMULATOR_CRASH_RE.search(sim_sys_log) is not None
+
+
+@functools.lru_cache(maxsize=32)
+def _GetAppCrashOnSimRe(app_bundle_id):
+  """Gets the compiled pattern of the app crash on simulator."""
+  return re.compile(_PATTERN_APP_CRASH_ON_SIM % re.escape(app_bundle_id))
+
+
+@functools.lru_cache(maxsize=128)
+def _GetSimTypeProfile(device_type):
+  """Gets the shared simtype_profile.SimTypeProfile object of device type."""
+  return simtype_profile.SimTypeProfile(device_type)
+
+
+@functools.lru_cache(maxsize=1)
+def _GetHomeDir():
+  """Gets the home directory of the effective user."""
+  return pwd.getpwuid(os.geteuid()).pw_dir
 
 
 def RunSimctlCommand(command):
-  """Runs simctl command."""
+  """Runs simctl command.
+
+  The command is retried if the CoreSimulatorService connection is
+  interrupted or the command times out.
+  """
   for i in range(_SIMCTL_MAX_ATTEMPTS):
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding='utf-8')
-    stdout, stderr = process.communicate()
-    all_output = '\n'.join([stdout, stderr])
-    output = stdout.strip()
-    if process.poll() != 0:
+    try:
+      result = subprocess.run(
+          command,
+          capture_output=True,
+          encoding='utf-8',
+          timeout=_SIMCTL_TIMEOUT_SEC,
+          check=False)
+    except subprocess.TimeoutExpired:
+      if i < _SIMCTL_MAX_ATTEMPTS - 1:
+        logging.warning('Timeout to run command %s in %ss. Will retry.',
+                        command, _SIMCTL_TIMEOUT_SEC)
+        continue
+      raise ios_errors.SimError('Timeout to run command %s in %ss.' %
+                                (command, _SIMCTL_TIMEOUT_SEC))
+    output = result.stdout.strip()
+    if result.returncode != 0:
       if (i < (_SIMCTL_MAX_ATTEMPTS - 1) and
-          ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in all_output):
+          (ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in result.stdout or
+           ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in result.stderr)):
         continue
       raise ios_errors.SimError(output)
     return output
+
+
+def _RunSimctlJsonCommand(command):
+  """Runs simctl command and loads its JSON output.
+
+  Args:
+    command: a list of string, the simctl command with the `-j` flag.
+
+  Returns:
+    the object loaded from the JSON output.
+
+  Raises:
+    ios_errors.SimError: when the command fails or times out.
+  """
+  output = RunSimctlCommand(list(command))
+  try:
+    return json.loads(output)
+  except ValueError:
+    raise ios_errors.SimError(
+        'Failed to load the JSON output of %s.' % ' '.join(command))
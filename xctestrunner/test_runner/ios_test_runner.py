@@ -20,16 +20,28 @@ environment variables and arguments to the test.
 """
 
 import argparse
+import concurrent.futures
+import contextlib
+import functools
 import json
 import logging
+import os
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 
 from xctestrunner.shared import ios_constants
 from xctestrunner.shared import ios_errors
-from xctestrunner.simulator_control import simulator_util
 from xctestrunner.test_runner import runner_exit_codes
-from xctestrunner.test_runner import xctest_session
+
+# orjson is an optional faster JSON parser.
+try:
+  import orjson  # pylint: disable=g-import-not-at-top
+except ImportError:
+  orjson = None
 
 _XCTESTRUN_HELP = (
     """The path of the xctestrun file.
@@ -39,6 +51,27 @@ testing by default. The parameters' values can also be overwritten by launch
 options.
 
 This argument is only supported in Xcode 8+.""")
+_TEST_TYPE_HELP = (
+    'The type of test bundle. Supported test types are %s. If this arg is '
+    'provided, will skip the test type detector.'
+    % (ios_constants.SUPPORTED_TEST_TYPES,))
+_UNSUPPORTED_PLATFORM_MSG = (
+    'The platform %%s is not supported. The supported values are %s.'
+    % (ios_constants.SUPPORTED_PLATFORMS,))
+# The timeout of `xcrun xcdevice list`, which may hang on a wedged device.
+_XCDEVICE_LIST_TIMEOUT_SEC = 60
+_KNOWN_DEVICES_CACHE_FILE_NAME = 'known_devices.json'
+# The environment variable of the TTL of the cached `xcrun xcdevice list`
+# output in seconds.
+_DEVICE_CACHE_TTL_ENV = 'XCTESTRUNNER_DEVICE_CACHE_TTL'
+_DEFAULT_DEVICE_CACHE_TTL_SEC = 60
+# The UDID of the real device, e.g., 00008030-001A2D3C0E12802E or 40 hex
+# digits on the older devices. The simulator UDID is a UUID.
+_REAL_DEVICE_ID_RE = re.compile(
+    r'^(?:[0-9A-Fa-f]{8}-[0-9A-Fa-f]{16}|[0-9A-Fa-f]{40})$')
+# Limits the number of the test shards which create, boot and run tests on
+# simulators at the same time.
+_MAX_PARALLEL_SHARDS = min(os.cpu_count() or 1, 4)
 
 
 def _AddGeneralArguments(parser):
@@ -83,9 +116,7 @@ def _AddGeneralArguments(parser):
       help=ios_constants.SIGNING_OPTIONS_JSON_HELP)
   optional_arguments.add_argument(
       '--test_type',
-      help='The type of test bundle. Supported test types are %s. If this arg '
-           'is provided, will skip the test type detector.'
-      % ios_constants.SUPPORTED_TEST_TYPES)
+      help=_TEST_TYPE_HELP)
   optional_arguments.add_argument(
       '--work_dir',
       help='The directory of runfiles, including the bundles, generated '
@@ -105,6 +136,7 @@ def _AddPrepareSubParser(subparsers):
   """Adds sub parser for sub command `prepare`."""
   def _Prepare(args):
     """The function of sub command `prepare`."""
+    from xctestrunner.test_runner import xctest_session  # pylint: disable=g-import-not-at-top
     sdk = _PlatformToSdk(args.platform) if args.platform else _GetSdk(args.id)
     device_arch = args.arch
     with xctest_session.XctestSession(
@@ -141,6 +173,7 @@ def _AddTestSubParser(subparsers):
   """Adds sub parser for sub command `test`."""
   def _Test(args):
     """The function of sub command `test`."""
+    from xctestrunner.test_runner import xctest_session  # pylint: disable=g-import-not-at-top
     sdk = _PlatformToSdk(args.platform) if args.platform else _GetSdk(args.id)
     device_arch = _GetDeviceArch(args.id, sdk)
     with xctest_session.XctestSession(
@@ -179,10 +212,55 @@ def _AddSimulatorTestSubParser(subparsers):
   """Adds sub parser for sub command `simulator_test`."""
   def _RunSimulatorTest(args):
     """The function of running test with new simulator."""
+    # Joins the prewarm worker before returning, so it never outlives the run.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=1) as prewarm_executor:
+      if args.app_under_test_path is None:
+        _PrewarmLogicTestLookups(prewarm_executor)
+      launch_options = _GetJson(args.launch_options_json_path)
+      shards = _ShardTestsToRun(launch_options, args.shard_count)
+      if len(shards) <= 1:
+        return _RunSimulatorTestShard(args, launch_options, args.xctestrun,
+                                      args.work_dir, args.output_dir)
+
+      logging.info('Running tests in %d shards on new simulators.', len(shards))
+      for dir_path in (args.work_dir, args.output_dir):
+        if dir_path and not os.path.exists(dir_path):
+          os.makedirs(dir_path)
+      with concurrent.futures.ThreadPoolExecutor(
+          max_workers=min(len(shards), _MAX_PARALLEL_SHARDS)) as executor:
+        futures = []
+        for index, tests_to_run in enumerate(shards):
+          shard_launch_options = dict(launch_options)
+          shard_launch_options['tests_to_run'] = tests_to_run
+          futures.append(executor.submit(
+              _RunSimulatorTestShardSafely, args, shard_launch_options, index))
+        return max(future.result() for future in futures)
+
+  def _RunSimulatorTestShardSafely(args, launch_options, shard_index):
+    """Runs a test shard and converts the simulator error to exit code."""
+    try:
+      # The tests to run are written into the xctestrun file, so each shard
+      # needs its own copy.
+      with _CopyXctestrunForShard(args.xctestrun,
+                                  shard_index) as xctestrun_file_path:
+        return _RunSimulatorTestShard(
+            args, launch_options, xctestrun_file_path,
+            _GetShardDir(args.work_dir, shard_index),
+            _GetShardDir(args.output_dir, shard_index))
+    except ios_errors.SimError as e:
+      logging.error('Failed to run test shard on simulator: %s', e)
+      return runner_exit_codes.EXITCODE.SIM_ERROR
+
+  def _RunSimulatorTestShard(args, launch_options, xctestrun_file_path,
+                             work_dir, output_dir):
+    """Runs the tests of launch options on a new simulator."""
+    from xctestrunner.simulator_control import simulator_util  # pylint: disable=g-import-not-at-top
+    from xctestrunner.test_runner import xctest_session  # pylint: disable=g-import-not-at-top
     with xctest_session.XctestSession(
         sdk=ios_constants.SDK.IPHONESIMULATOR,
         device_arch=ios_constants.ARCH.X86_64,
-        work_dir=args.work_dir, output_dir=args.output_dir) as session:
+        work_dir=work_dir, output_dir=output_dir) as session:
       simulator_id, _, os_version, _ = simulator_util.CreateNewSimulator(
           device_type=args.device_type,
           os_version=args.os_version,
@@ -195,10 +273,10 @@ def _AddSimulatorTestSubParser(subparsers):
         session.Prepare(
             app_under_test=args.app_under_test_path,
             test_bundle=args.test_bundle_path,
-            xctestrun_file_path=args.xctestrun,
+            xctestrun_file_path=xctestrun_file_path,
             test_type=args.test_type,
             signing_options=_GetJson(args.signing_options_json_path))
-        session.SetLaunchOptions(_GetJson(args.launch_options_json_path))
+        session.SetLaunchOptions(launch_options)
         if not hostless:
           try:
             simulator_obj.BootStatus().wait(timeout=60)
@@ -212,6 +290,9 @@ def _AddSimulatorTestSubParser(subparsers):
 
   def _SimulatorTest(args):
     """The function of sub command `simulator_test`."""
+    from xctestrunner.simulator_control import simulator_util  # pylint: disable=g-import-not-at-top
+    if args.no_sim_pool:
+      simulator_util.DisableSimPool()
     try:
       return _RunSimulatorTest(args)
     except ios_errors.SimError:
@@ -220,7 +301,8 @@ def _AddSimulatorTestSubParser(subparsers):
   test_parser = subparsers.add_parser(
       'simulator_test',
       help='Run test on a new created simulator, which will be deleted '
-           'after test finishes.')
+           'after test finishes. The simulator may be reused from the '
+           'simulator pool if it is enabled.')
   test_parser.add_argument(
       '--device_type',
       help='The device type of the simulator to run test. The supported types '
@@ -238,36 +320,146 @@ def _AddSimulatorTestSubParser(subparsers):
            'The new simulator name will be the value of concatenating name '
            'prefix with simulator type and os version. '
            'E.g., New-iPhone 6 Plus-10.2.')
+  test_parser.add_argument(
+      '--shard_count',
+      type=int,
+      default=1,
+      help='The number of shards to split the tests_to_run of launch options '
+           'into. Each shard runs on its own new simulator in parallel, and '
+           'writes its outputs to the shard_<index> subdirectory of '
+           'output_dir. By default, it is 1.')
+  test_parser.add_argument(
+      '--no_sim_pool',
+      action='store_true',
+      help='Creates and deletes the simulator even if the simulator pool is '
+           'enabled by the environment variable XCTESTRUNNER_SIM_POOL=1. With '
+           'the pool, the simulator is erased and kept for the later runs '
+           'instead of being deleted. The pool size of each device type and '
+           'OS version is set by XCTESTRUNNER_SIM_POOL_SIZE (default 2).')
   test_parser.set_defaults(func=_SimulatorTest)
 
 
-def _BuildParser():
+# The functions to add the sub parsers, keyed by the sub command.
+_SUB_PARSER_ADDERS = {
+    'prepare': _AddPrepareSubParser,
+    'test': _AddTestSubParser,
+    'simulator_test': _AddSimulatorTestSubParser,
+}
+
+
+def _BuildParser(args=None):
   """Builds a parser which is to parse arguments/sub commands of test runner.
 
+  Args:
+    args: list of string, the arguments to parse. If only one sub command
+      appears in them, only the parser of that sub command is built.
+
   Returns:
     a argparse object.
   """
   parser = argparse.ArgumentParser(
       formatter_class=argparse.RawTextHelpFormatter)
   _AddGeneralArguments(parser)
-  subparsers = parser.add_subparsers(help='Sub-commands help')
-  _AddPrepareSubParser(subparsers)
-  _AddTestSubParser(subparsers)
-  _AddSimulatorTestSubParser(subparsers)
+  subparsers = parser.add_subparsers(
+      dest='sub_command', required=True, help='Sub-commands help')
+  sub_commands = set(args or ()).intersection(_SUB_PARSER_ADDERS)
+  if len(sub_commands) != 1:
+    sub_commands = _SUB_PARSER_ADDERS
+  for sub_command, add_sub_parser in _SUB_PARSER_ADDERS.items():
+    if sub_command in sub_commands:
+      add_sub_parser(subparsers)
   return parser
 
 
 def _GetJson(json_path):
   """Gets the json dict from the file."""
   if json_path:
-    with open(json_path) as input_file:
-      try:
-        return json.load(input_file)
-      except ValueError as e:
-        raise ios_errors.IllegalArgumentError(e)
+    with open(json_path, 'rb') as input_file:
+      json_bytes = input_file.read()
+    # The decode errors of both orjson and json are ValueError.
+    try:
+      if orjson:
+        return orjson.loads(json_bytes)
+      return json.loads(json_bytes)
+    except ValueError as e:
+      raise ios_errors.IllegalArgumentError(e)
   return None
 
 
+def _ShardTestsToRun(launch_options, shard_count):
+  """Splits the tests_to_run of the launch options into shards.
+
+  Args:
+    launch_options: dict, the launch options. See
+        ios_constants.LAUNCH_OPTIONS_JSON_HELP for details.
+    shard_count: int, the number of shards.
+
+  Returns:
+    a list of shards, each item is a list of tests to run. If the tests can not
+    be sharded, returns a list with the single item None.
+  """
+  tests_to_run = launch_options.get('tests_to_run') if launch_options else None
+  if not shard_count or shard_count <= 1:
+    return [None]
+  if not tests_to_run:
+    logging.warning('The tests can not be sharded without the tests_to_run in '
+                    'launch options. Will run them in one shard.')
+    return [None]
+  shard_count = min(shard_count, len(tests_to_run))
+  return [tests_to_run[i::shard_count] for i in range(shard_count)]
+
+
+def _PrewarmLogicTestLookups(executor):
+  """Starts the lookups of logic test which don't depend on the simulator.
+
+  They overlap with the simulator creation. The results are kept in the caches
+  of the lookup functions, and the errors are raised again by the later calls.
+
+  Args:
+    executor: concurrent.futures.Executor, the executor to run the lookups.
+  """
+  from xctestrunner.shared import xcode_info_util  # pylint: disable=g-import-not-at-top
+  # The logic test runs the xctest tool of the simulator platform.
+  executor.submit(xcode_info_util.GetXctestToolPath,
+                  ios_constants.SDK.IPHONESIMULATOR)
+
+
+@contextlib.contextmanager
+def _CopyXctestrunForShard(xctestrun_file_path, shard_index):
+  """Copies the xctestrun file for the test shard and removes it at last.
+
+  The copy is in the same directory as the original file, so the __TESTROOT__
+  paths in it are resolved to the same directory by xcodebuild.
+
+  Args:
+    xctestrun_file_path: string, the path of the xctestrun file or None.
+    shard_index: int, the index of the test shard.
+
+  Yields:
+    string, the path of the copied xctestrun file or None.
+  """
+  if not xctestrun_file_path:
+    yield None
+    return
+  file_name = os.path.splitext(os.path.basename(xctestrun_file_path))[0]
+  fd, shard_file_path = tempfile.mkstemp(
+      suffix='.xctestrun', prefix='%s.shard_%d.' % (file_name, shard_index),
+      dir=os.path.dirname(os.path.abspath(xctestrun_file_path)))
+  os.close(fd)
+  try:
+    shutil.copyfile(xctestrun_file_path, shard_file_path)
+    yield shard_file_path
+  finally:
+    os.remove(shard_file_path)
+
+
+def _GetShardDir(dir_path, shard_index):
+  """Gets the directory of the shard under the given directory or None."""
+  if not dir_path:
+    return None
+  return os.path.join(dir_path, 'shard_%d' % shard_index)
+
+
 def _PlatformToSdk(platform):
   """Gets the SDK of the given platform."""
   if platform == ios_constants.PLATFORM.IOS_DEVICE:
@@ -275,22 +467,107 @@ def _PlatformToSdk(platform):
   if platform == ios_constants.PLATFORM.IOS_SIMULATOR:
     return ios_constants.SDK.IPHONESIMULATOR
   raise ios_errors.IllegalArgumentError(
-      'The platform %s is not supported. The supported values are %s.' %
-      (platform, ios_constants.SUPPORTED_PLATFORMS))
+      _UNSUPPORTED_PLATFORM_MSG % platform)
 
 
+@functools.lru_cache(maxsize=None)
 def _GetSdk(device_id):
   """Gets the sdk of the target device with the given device_id."""
-  devices_list_output = subprocess.check_output(
-      ['xcrun', 'xcdevice', 'list']).decode('utf-8')
+  # Checks the simulators first, `simctl list` is much faster than `xcdevice`.
+  # The id in the real device format can not be a simulator, so skips it.
+  if not _REAL_DEVICE_ID_RE.match(device_id):
+    from xctestrunner.simulator_control import simulator_util  # pylint: disable=g-import-not-at-top
+    sim_devices_json = json.loads(
+        simulator_util.RunSimctlCommand(
+            ['xcrun', 'simctl', 'list', 'devices', '-j']))
+    sim_device_ids = {
+        sim_device['udid']
+        for sim_devices in sim_devices_json['devices'].values()
+        for sim_device in sim_devices
+    }
+    if device_id in sim_device_ids:
+      return ios_constants.SDK.IPHONESIMULATOR
+
+  devices_list_output, is_cached = _GetKnownDevicesOutput()
+  sdk = _FindSdkInKnownDevices(devices_list_output, device_id)
+  if sdk is None and is_cached:
+    # The cached known devices may be out of date.
+    devices_list_output, _ = _GetKnownDevicesOutput(use_cache=False)
+    sdk = _FindSdkInKnownDevices(devices_list_output, device_id)
+  if sdk:
+    return sdk
+
+  raise ios_errors.IllegalArgumentError(
+      'The device with id %s can not be found. The known devices are %s.' %
+      (device_id, devices_list_output))
+
+
+def _FindSdkInKnownDevices(devices_list_output, device_id):
+  """Finds the sdk of the device in the output of `xcrun xcdevice list`."""
   for device_info in json.loads(devices_list_output):
     if device_info['identifier'] == device_id:
       return ios_constants.SDK.IPHONESIMULATOR if device_info[
           'simulator'] else ios_constants.SDK.IPHONEOS
+  return None
 
-  raise ios_errors.IllegalArgumentError(
-      'The device with id %s can not be found. The known devices are %s.' %
-      (device_id, devices_list_output))
+
+def _GetKnownDevicesOutput(use_cache=True):
+  """Gets the output of `xcrun xcdevice list`.
+
+  The output is cached in a file for XCTESTRUNNER_DEVICE_CACHE_TTL seconds
+  (60 by default, 0 to disable the cache), because the command may take
+  several seconds.
+
+  Args:
+    use_cache: bool, whether to use the cached output if it is not expired.
+
+  Returns:
+    a tuple with two items:
+      string, the output of `xcrun xcdevice list`.
+      bool, whether the output is from the cache.
+  """
+  cache_path = _GetKnownDevicesCachePath()
+  ttl_sec = _GetDeviceCacheTtlSec()
+  if use_cache and ttl_sec > 0:
+    try:
+      if time.time() - os.path.getmtime(cache_path) < ttl_sec:
+        with open(cache_path) as cache_file:
+          return cache_file.read(), True
+    except OSError:
+      pass
+  devices_list_output = subprocess.check_output(
+      ['xcrun', 'xcdevice', 'list'],
+      timeout=_XCDEVICE_LIST_TIMEOUT_SEC).decode('utf-8')
+  if ttl_sec > 0:
+    # The cache is only an optimization, so ignores the failures of writing.
+    try:
+      os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+      fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+      with os.fdopen(fd, 'w') as cache_file:
+        cache_file.write(devices_list_output)
+      os.replace(temp_file_path, cache_path)
+    except OSError:
+      pass
+  return devices_list_output, False
+
+
+def _GetKnownDevicesCachePath():
+  """Gets the path of the cache file of the known devices."""
+  cache_home_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+      os.path.expanduser('~'), 'Library/Caches')
+  return os.path.join(cache_home_dir, 'xctestrunner',
+                      _KNOWN_DEVICES_CACHE_FILE_NAME)
+
+
+def _GetDeviceCacheTtlSec():
+  """Gets the TTL of the cached known devices in seconds."""
+  try:
+    return int(os.environ.get(_DEVICE_CACHE_TTL_ENV,
+                              _DEFAULT_DEVICE_CACHE_TTL_SEC))
+  except ValueError:
+    logging.warning('The value of %s should be an integer.',
+                    _DEVICE_CACHE_TTL_ENV)
+    return _DEFAULT_DEVICE_CACHE_TTL_SEC
 
 
 def _GetDeviceArch(device_id, sdk):
@@ -305,11 +582,15 @@ def _GetDeviceArch(device_id, sdk):
 
 
 def main(argv):
-  args = _BuildParser().parse_args(argv[1:])
+  args = _BuildParser(argv[1:]).parse_args(argv[1:])
   if args.verbose:
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s')
-  else:
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s',
+                        datefmt='%H:%M:%S')
+  elif sys.stderr.isatty():
     logging.basicConfig(format='%(asctime)s %(message)s')
+  else:
+    # The log consumer, e.g. CI, usually timestamps the piped lines itself.
+    logging.basicConfig(format='%(message)s')
   exit_code = args.func(args)
   logging.info('Done.')
   return exit_code
@@ -14,6 +14,7 @@
 
 """The helper classes to run logic test."""
 
+import logging
 import os
 import subprocess
 import sys
@@ -24,6 +25,11 @@ from xctestrunner.shared import xcode_info_util
 from xctestrunner.test_runner import runner_exit_codes
 
 _SIMCTL_ENV_VAR_PREFIX = 'SIMCTL_CHILD_'
+_SIMCTL_DYLD_FALLBACK_LIBRARY_PATH_KEY = (
+    _SIMCTL_ENV_VAR_PREFIX + 'DYLD_FALLBACK_LIBRARY_PATH')
+# The environment variable of the timeout of the logic test process in seconds.
+_LOGIC_TEST_TIMEOUT_ENV = 'XCTESTRUNNER_LOGIC_TIMEOUT'
+_DEFAULT_LOGIC_TEST_TIMEOUT_SEC = 1500
 
 
 def RunLogicTestOnSim(sim_id,
@@ -50,10 +56,8 @@ def RunLogicTestOnSim(sim_id,
   Raises:
     ios_errors.SimError: The command to launch logic test has error.
   """
-  simctl_env_vars = {}
-  if env_vars:
-    for key in env_vars:
-      simctl_env_vars[_SIMCTL_ENV_VAR_PREFIX + key] = env_vars[key]
+  simctl_env_vars = {_SIMCTL_ENV_VAR_PREFIX + key: value
+                     for key, value in (env_vars or {}).items()}
   simctl_env_vars['NSUnbufferedIO'] = 'YES'
   # When running tests on iOS 12.1 or earlier simulator under Xcode 11 or later,
   # it is required to add swift5 fallback libraries to environment variable.
@@ -61,12 +65,10 @@ def RunLogicTestOnSim(sim_id,
   if (xcode_info_util.GetXcodeVersionNumber() >= 1100 and
       os_version and
       version_util.GetVersionNumber(os_version) < 1220):
-    key = _SIMCTL_ENV_VAR_PREFIX + 'DYLD_FALLBACK_LIBRARY_PATH'
-    simctl_env_vars[key] = xcode_info_util.GetSwift5FallbackLibsDir()
-  # We need to set the DEVELOPER_DIR to ensure xcrun works correctly
-  developer_dir = os.environ.get('DEVELOPER_DIR')
-  if developer_dir:
-    simctl_env_vars['DEVELOPER_DIR'] = developer_dir
+    swift5_fallback_libs_dir = xcode_info_util.GetSwift5FallbackLibsDir()
+    if swift5_fallback_libs_dir:
+      simctl_env_vars[_SIMCTL_DYLD_FALLBACK_LIBRARY_PATH_KEY] = (
+          swift5_fallback_libs_dir)
   command = [
       'xcrun', 'simctl', 'spawn', '-s', sim_id,
       xcode_info_util.GetXctestToolPath(ios_constants.SDK.IPHONESIMULATOR)]
@@ -77,9 +79,31 @@ def RunLogicTestOnSim(sim_id,
   else:
     tests_to_run_str = ','.join(tests_to_run)
 
-  return_code = subprocess.Popen(
-      command + ['-XCTest', tests_to_run_str, test_bundle_path],
-      env=simctl_env_vars, stdout=sys.stdout, stderr=subprocess.STDOUT).wait()
+  timeout_sec = _GetLogicTestTimeoutSec()
+  try:
+    return_code = subprocess.run(
+        command + ['-XCTest', tests_to_run_str, test_bundle_path],
+        # Inherits the host environment, e.g., PATH, HOME and DEVELOPER_DIR
+        # which xcrun needs. Only the prefixed vars are passed to the test.
+        env={**os.environ, **simctl_env_vars},
+        stdout=sys.stdout,
+        stderr=subprocess.STDOUT,
+        check=False,
+        timeout=timeout_sec).returncode
+  except subprocess.TimeoutExpired:
+    logging.error('The logic test did not finish in %ss.', timeout_sec)
+    return runner_exit_codes.EXITCODE.FAILED
   if return_code != 0:
     return runner_exit_codes.EXITCODE.FAILED
   return runner_exit_codes.EXITCODE.SUCCEEDED
+
+
+def _GetLogicTestTimeoutSec():
+  """Gets the timeout of the logic test process in seconds."""
+  try:
+    return int(os.environ.get(_LOGIC_TEST_TIMEOUT_ENV,
+                              _DEFAULT_LOGIC_TEST_TIMEOUT_SEC))
+  except ValueError:
+    logging.warning('The value of %s should be an integer.',
+                    _LOGIC_TEST_TIMEOUT_ENV)
+    return _DEFAULT_LOGIC_TEST_TIMEOUT_SEC
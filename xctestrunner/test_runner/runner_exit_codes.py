@@ -14,19 +14,23 @@
 
 """The exit codes of test runner."""
 
+import enum
 
-def enum(**enums):
-  return type('Enum', (), enums)
 
-EXITCODE = enum(
-    SUCCEEDED=0,
-    ERROR=1,
-    UNKNOWN=10,
-    FAILED=11,
-    TEST_NOT_START=12,
-    NEED_REBOOT_DEVICE=13,
-    NEED_RECREATE_SIM=14,
-    SIM_ERROR=15)
+class EXITCODE(enum.IntEnum):
+  """The exit code of test runner."""
+  SUCCEEDED = 0
+  ERROR = 1
+  UNKNOWN = 10
+  FAILED = 11
+  TEST_NOT_START = 12
+  NEED_REBOOT_DEVICE = 13
+  NEED_RECREATE_SIM = 14
+  SIM_ERROR = 15
+
+  def __str__(self):
+    return str(self.value)
+
 
 EXITCODE_INFOS = {
     EXITCODE.SUCCEEDED: 'Test succeed',
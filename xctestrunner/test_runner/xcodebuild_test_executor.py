@@ -14,14 +14,16 @@
 
 """Helper class for running test by xcodebuild tool."""
 
-import io
+import concurrent.futures
+import functools
 import logging
 import os
 import random
 import re
+import selectors
 import shutil
 import subprocess
-import threading
+import sys
 import time
 
 from xctestrunner.shared import ios_constants
@@ -35,56 +37,96 @@ _XCODEBUILD_TEST_STARTUP_TIMEOUT_SEC = 150
 _SIM_TEST_MAX_ATTEMPTS = 3
 _DEVICE_TEST_MAX_ATTEMPTS = 2
 _TAIL_SIM_LOG_LINE = 200
-_BACKGROUND_TEST_RUNNER_ERROR = 'Failed to background test runner'
-_PROCESS_EXISTED_OR_CRASHED_ERROR = ('The process did launch, but has since '
-                                     'exited or crashed.')
-_REQUEST_DENIED_ERROR = ('The request was denied by service delegate '
-                         '(SBMainWorkspace) for reason')
+_BACKGROUND_TEST_RUNNER_ERROR = b'Failed to background test runner'
+_PROCESS_EXISTED_OR_CRASHED_ERROR = (b'The process did launch, but has since '
+                                     b'exited or crashed.')
+_REQUEST_DENIED_ERROR = (b'The request was denied by service delegate '
+                         b'(SBMainWorkspace) for reason')
 _APP_UNKNOWN_TO_FRONTEND_PATTERN = re.compile(
-    'Application ".*" is unknown to FrontBoard.')
-_INIT_SIM_SERVICE_ERROR = 'Failed to initiate service connection to simulator'
+    b'Application ".*" is unknown to FrontBoard.')
+_INIT_SIM_SERVICE_ERROR = b'Failed to initiate service connection to simulator'
 _DEVICE_TYPE_WAS_NULL_PATTERN = re.compile(
-    'DTDeviceKit: deviceType from .* was NULL')
-_TOO_MANY_INSTANCES_ALREADY_RUNNING = ('Too many instances of this service are '
-                                       'already running.')
-_LOST_CONNECTION_ERROR = 'Lost connection to testmanagerd'
-_LOST_CONNECTION_TO_DTSERVICEHUB_ERROR = 'Lost connection to DTServiceHub'
-_DEVICE_NO_LONGER_CONNECTED = 'This device is no longer connected'
-_UNABLE_FIND_DEVICE_IDENTIFIER = 'Unable to find device with identifier'
-_BUNDLE_DAMAGED = 'The bundle is damaged or missing necessary resources.'
-
-
-class CheckXcodebuildStuckThread(threading.Thread):
-  """The thread class that checking if xcodebuild process stucks.
-
-  The thread will stop gracefully when it is called Terminate() or the given
-  process is terminated or reaching the given timeout. If reaching the given
-  timeout, this thread will also kill the given xcodebuild process.
+    b'DTDeviceKit: deviceType from .* was NULL')
+_TOO_MANY_INSTANCES_ALREADY_RUNNING = (b'Too many instances of this service '
+                                       b'are already running.')
+_LOST_CONNECTION_ERROR = b'Lost connection to testmanagerd'
+_LOST_CONNECTION_TO_DTSERVICEHUB_ERROR = b'Lost connection to DTServiceHub'
+_DEVICE_NO_LONGER_CONNECTED = b'This device is no longer connected'
+_UNABLE_FIND_DEVICE_IDENTIFIER = b'Unable to find device with identifier'
+_BUNDLE_DAMAGED = b'The bundle is damaged or missing necessary resources.'
+# The unions of the errors of each check.
+_NEED_RECREATE_SIM_PATTERN = re.compile(b'|'.join((
+    _APP_UNKNOWN_TO_FRONTEND_PATTERN.pattern,
+    re.escape(_REQUEST_DENIED_ERROR),
+    re.escape(_INIT_SIM_SERVICE_ERROR))))
+_NEED_RETRY_DEVICE_TEST_PATTERN = re.compile(b'|'.join((
+    _DEVICE_TYPE_WAS_NULL_PATTERN.pattern,
+    re.escape(_LOST_CONNECTION_ERROR),
+    re.escape(_LOST_CONNECTION_TO_DTSERVICEHUB_ERROR),
+    re.escape(_DEVICE_NO_LONGER_CONNECTED),
+    re.escape(_UNABLE_FIND_DEVICE_IDENTIFIER))))
+# The errors in the output before the test starts, keyed by the group names of
+# _OUTPUT_ERRORS_PATTERN.
+_OUTPUT_ERRORS = {
+    'BUNDLE_DAMAGED': re.escape(_BUNDLE_DAMAGED),
+    'NEED_RETRY_DEVICE_TEST': _NEED_RETRY_DEVICE_TEST_PATTERN.pattern,
+    'TOO_MANY_INSTANCES_ALREADY_RUNNING': re.escape(
+        _TOO_MANY_INSTANCES_ALREADY_RUNNING),
+    'BACKGROUND_TEST_RUNNER_ERROR': re.escape(_BACKGROUND_TEST_RUNNER_ERROR),
+    'NEED_RECREATE_SIM': _NEED_RECREATE_SIM_PATTERN.pattern,
+    'PROCESS_EXISTED_OR_CRASHED_ERROR': re.escape(
+        _PROCESS_EXISTED_OR_CRASHED_ERROR),
+    'CORESIMULATOR_INTERRUPTED_ERROR': re.escape(
+        ios_constants.CORESIMULATOR_INTERRUPTED_ERROR.encode()),
+}
+# Finds all the errors of a block of output lines in one scan.
+_OUTPUT_ERRORS_PATTERN = re.compile(b'|'.join(
+    b'(?P<%s>%s)' % (name.encode(), pattern)
+    for name, pattern in _OUTPUT_ERRORS.items()))
+# The chars of the test cache file directory name under EmbeddedAppDeltas.
+_TEST_CACHE_FILE_DIR_NAME_CHARS = frozenset(
+    b'abcdefghijklmnopqrstuvwxyz0123456789')
+# The max size of each read of the xcodebuild output.
+_OUTPUT_READ_SIZE = 1 << 16
+
+
+class CheckXcodebuildStuck(object):
+  """The class that checking if xcodebuild process stucks.
+
+  It has no thread of its own. The output reading loop waits for the output at
+  most GetTimeout() seconds, and calls Check() when the wait times out. If
+  reaching the given timeout before Terminate() is called, it will kill the
+  given xcodebuild process.
   """
 
   def __init__(self, xcodebuild_test_popen, startup_timeout_sec):
-    super(CheckXcodebuildStuckThread, self).__init__()
     self._xcodebuild_test_popen = xcodebuild_test_popen
     self._terminate = False
     self._is_xcodebuild_stuck = False
     self._startup_timeout_sec = startup_timeout_sec
-
-  def run(self):
-    start_time = time.time()
-    while (not self._terminate and
-           start_time + self._startup_timeout_sec >= time.time() and
-           self._xcodebuild_test_popen.poll() is None):
-      time.sleep(2)
-    if (not self._terminate and
-        start_time + self._startup_timeout_sec < time.time()):
-      logging.warning(
-          'The xcodebuild command got stuck and has not started test in %d. '
-          'Will kill the command directly.', self._startup_timeout_sec)
-      self._is_xcodebuild_stuck = True
-      self._xcodebuild_test_popen.terminate()
+    self._deadline = time.monotonic() + startup_timeout_sec
+
+  def GetTimeout(self):
+    """Gets the seconds until the timeout, or None if it is terminated."""
+    if self._terminate:
+      return None
+    return max(0, self._deadline - time.monotonic())
+
+  def Check(self):
+    """Kills the xcodebuild process if it is stuck in the timeout."""
+    if self._terminate or time.monotonic() < self._deadline:
+      return
+    self._terminate = True
+    if self._xcodebuild_test_popen.poll() is not None:
+      return
+    logging.warning(
+        'The xcodebuild command got stuck and has not started test in %d. '
+        'Will kill the command directly.', self._startup_timeout_sec)
+    self._is_xcodebuild_stuck = True
+    self._xcodebuild_test_popen.terminate()
 
   def Terminate(self):
-    """Terminates this thread."""
+    """Stops checking."""
     self._terminate = True
 
   @property
@@ -148,56 +190,84 @@ class XcodebuildTestExecutor(object):
     run_env = dict(os.environ)
     run_env['NSUnbufferedIO'] = 'YES'
     max_attempts = 1
+    simulator_obj = None
     sim_log_path = None
     if self._sdk == ios_constants.SDK.IPHONESIMULATOR:
       max_attempts = _SIM_TEST_MAX_ATTEMPTS
       if self._device_id:
-        sim_log_path = simulator_util.Simulator(
-            self._device_id).simulator_system_log_path
+        # Reuses the simulator object in all attempts.
+        simulator_obj = simulator_util.Simulator(self._device_id)
+        sim_log_path = simulator_obj.simulator_system_log_path
     elif self._sdk == ios_constants.SDK.IPHONEOS:
       max_attempts = _DEVICE_TEST_MAX_ATTEMPTS
 
     test_started = False
     test_succeeded = False
     test_failed = False
+    # The output is scanned as raw bytes, without decoding it line by line.
+    test_started_signal = ios_constants.TEST_STARTED_SIGNAL.encode()
+    xctrunner_started_signal = ios_constants.XCTRUNNER_STARTED_SIGNAL.encode()
+    succeeded_signal = (
+        self._succeeded_signal.encode() if self._succeeded_signal else None)
+    failed_signal = (
+        self._failed_signal.encode() if self._failed_signal else None)
+    # If return_output is false, the output is only kept for deleting the
+    # cached files of the real device (_DeleteTestCacheFileDirs method).
+    on_device = self._sdk == ios_constants.SDK.IPHONEOS
 
     for i in range(max_attempts):
       if result_bundle_path and os.path.exists(result_bundle_path):
         shutil.rmtree(result_bundle_path, ignore_errors=True)
+      # The pipe is read by os.read in large chunks, so it is unbuffered to
+      # not keep an unused buffer in between.
       process = subprocess.Popen(
           self._command, env=run_env, stdout=subprocess.PIPE,
-          stderr=subprocess.STDOUT, encoding='ascii', errors='ignore')
-      check_xcodebuild_stuck = CheckXcodebuildStuckThread(
+          stderr=subprocess.STDOUT, bufsize=0)
+      check_xcodebuild_stuck = CheckXcodebuildStuck(
           process, self._startup_timeout_sec)
-      check_xcodebuild_stuck.start()
-      output = io.StringIO()
-      for stdout_line in process.stdout:
+      output_chunks = []
+      # The names of the errors found in the output before the test starts.
+      output_errors = set()
+      for lines in _ReadCompleteLines(process.stdout.fileno(),
+                                      check_xcodebuild_stuck):
+        _WriteToStdout(lines)
+        # The lines after the test started signal line.
+        test_lines = lines
         if not test_started:
-          # Terminates the CheckXcodebuildStuckThread when test has started
+          # Terminates the CheckXcodebuildStuck when test has started
           # or XCTRunner.app has started.
           # But XCTRunner.app start does not mean test start.
-          if ios_constants.TEST_STARTED_SIGNAL in stdout_line:
+          signal_pos = lines.find(test_started_signal)
+          if signal_pos >= 0:
             test_started = True
             check_xcodebuild_stuck.Terminate()
-          # Only terminate the check_xcodebuild_stuck thread when running on
+            if not return_output and on_device:
+              output_chunks.append(
+                  lines[:lines.rfind(b'\n', 0, signal_pos) + 1])
+            line_end = lines.find(b'\n', signal_pos) + 1
+            test_lines = lines[line_end:] if line_end else b''
+          # Only terminate the check_xcodebuild_stuck when running on
           # iphonesimulator device. When running on iphoneos device, the
           # XCTRunner.app may not launch the test session sometimes
           # (error rate < 1%).
-          if (self._test_type == ios_constants.TestType.XCUITEST and
-              ios_constants.XCTRUNNER_STARTED_SIGNAL in stdout_line and
-              self._sdk == ios_constants.SDK.IPHONESIMULATOR):
+          elif (self._test_type == ios_constants.TestType.XCUITEST and
+                xctrunner_started_signal in lines and
+                self._sdk == ios_constants.SDK.IPHONESIMULATOR):
             check_xcodebuild_stuck.Terminate()
-        else:
-          if self._succeeded_signal and self._succeeded_signal in stdout_line:
+        if not test_started:
+          # Classifies the errors while reading, so the checks after the run
+          # don't scan the whole output again.
+          output_errors.update(
+              match.lastgroup
+              for match in _OUTPUT_ERRORS_PATTERN.finditer(lines))
+        if test_started:
+          if succeeded_signal and succeeded_signal in test_lines:
             test_succeeded = True
-          if self._failed_signal and self._failed_signal in stdout_line:
+          if failed_signal and failed_signal in test_lines:
             test_failed = True
 
-        print(stdout_line, flush=True, end='')
-        # If return_output is false, the output is only used for checking error
-        # cause and deleting cached files (_DeleteTestCacheFileDirs method).
-        if return_output or not test_started:
-          output.write(stdout_line)
+        if return_output or (on_device and not test_started):
+          output_chunks.append(lines)
 
       try:
         if test_started:
@@ -207,20 +277,24 @@ class XcodebuildTestExecutor(object):
             exit_code = runner_exit_codes.EXITCODE.FAILED
           else:
             exit_code = runner_exit_codes.EXITCODE.ERROR
-          return exit_code, output.getvalue() if return_output else None
+          if not return_output:
+            return exit_code, None
+          return exit_code, _DecodeOutput(b''.join(output_chunks))
+
+        # The output is only decoded when it is returned.
+        output = (
+            _DecodeOutput(b''.join(output_chunks)) if return_output else None)
 
         check_xcodebuild_stuck.Terminate()
         if check_xcodebuild_stuck.is_xcodebuild_stuck:
-          return self._GetResultForXcodebuildStuck(output, return_output)
+          return self._GetResultForXcodebuildStuck(output)
 
-        output_str = output.getvalue()
         # Don't need to retry the case for the damaged test bundle.
-        if _BUNDLE_DAMAGED in output_str:
-          return (runner_exit_codes.EXITCODE.TEST_NOT_START,
-                  output_str if return_output else None)
+        if 'BUNDLE_DAMAGED' in output_errors:
+          return runner_exit_codes.EXITCODE.TEST_NOT_START, output
 
         if self._sdk == ios_constants.SDK.IPHONEOS:
-          if (self._NeedRetryForDeviceTesting(output_str) and
+          if (self._NeedRetryForDeviceTesting(output_errors) and
               i < max_attempts - 1):
             logging.warning(
                 'Failed to launch test on the device. Will relaunch again '
@@ -228,109 +302,172 @@ class XcodebuildTestExecutor(object):
             )
             time.sleep(5)
             continue
-          if _TOO_MANY_INSTANCES_ALREADY_RUNNING in output_str:
-            return (runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE,
-                    output_str if return_output else None)
+          if 'TOO_MANY_INSTANCES_ALREADY_RUNNING' in output_errors:
+            return runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE, output
 
         if self._sdk == ios_constants.SDK.IPHONESIMULATOR:
-          if self._NeedRebootSim(output_str):
-            return (runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE,
-                    output_str if return_output else None)
-          if self._NeedRecreateSim(output_str):
-            return (runner_exit_codes.EXITCODE.NEED_RECREATE_SIM,
-                    output_str if return_output else None)
+          if self._NeedRebootSim(output_errors):
+            return runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE, output
+          if self._NeedRecreateSim(output_errors):
+            return runner_exit_codes.EXITCODE.NEED_RECREATE_SIM, output
 
           # The following error can be fixed by relaunching the test again.
-          try:
-            if sim_log_path and os.path.exists(sim_log_path):
-              # Sleeps short time. Then the tail simulator log can get more log.
-              time.sleep(0.5)
-              tail_sim_log = _ReadFileTailInShell(
-                  sim_log_path, _TAIL_SIM_LOG_LINE)
-              if (self._test_type == ios_constants.TestType.LOGIC_TEST and
-                  simulator_util.IsXctestFailedToLaunchOnSim(tail_sim_log) or
-                  self._test_type != ios_constants.TestType.LOGIC_TEST and
-                  simulator_util.IsAppFailedToLaunchOnSim(tail_sim_log) or
-                  simulator_util.IsCoreSimulatorCrash(tail_sim_log)):
+          # There is no relaunch in the last attempt, so skips the probes and
+          # their sleeps there.
+          if i < max_attempts - 1:
+            try:
+              if sim_log_path and os.path.exists(sim_log_path):
+                # Sleeps short time. Then the tail simulator log can get more
+                # log.
+                time.sleep(0.5)
+                tail_sim_log = _ReadFileTail(sim_log_path, _TAIL_SIM_LOG_LINE)
+                if (self._test_type == ios_constants.TestType.LOGIC_TEST and
+                    simulator_util.IsXctestFailedToLaunchOnSim(tail_sim_log) or
+                    self._test_type != ios_constants.TestType.LOGIC_TEST and
+                    simulator_util.IsAppFailedToLaunchOnSim(tail_sim_log) or
+                    simulator_util.IsCoreSimulatorCrash(tail_sim_log)):
+                  raise ios_errors.SimError('')
+              if 'PROCESS_EXISTED_OR_CRASHED_ERROR' in output_errors:
+                raise ios_errors.SimError('')
+              if 'CORESIMULATOR_INTERRUPTED_ERROR' in output_errors:
+                # Sleep random[0,2] seconds to avoid race condition. It is a
+                # known issue that CoreSimulatorService connection will be
+                # interrupted if two simulators are booting at the same time.
+                time.sleep(random.uniform(0, 2))
+                raise ios_errors.SimError('')
+              if (self._app_bundle_id and simulator_obj and
+                  not simulator_obj.IsAppInstalled(self._app_bundle_id)):
                 raise ios_errors.SimError('')
-            if _PROCESS_EXISTED_OR_CRASHED_ERROR in output_str:
-              raise ios_errors.SimError('')
-            if ios_constants.CORESIMULATOR_INTERRUPTED_ERROR in output_str:
-              # Sleep random[0,2] seconds to avoid race condition. It is a known
-              # issue that CoreSimulatorService connection will be interrupted
-              # if two simulators are booting at the same time.
-              time.sleep(random.uniform(0, 2))
-              raise ios_errors.SimError('')
-            if (self._app_bundle_id and
-                not simulator_util.Simulator(self._device_id).IsAppInstalled(
-                    self._app_bundle_id)):
-              raise ios_errors.SimError('')
-          except ios_errors.SimError:
-            if i < max_attempts - 1:
+            except ios_errors.SimError:
               logging.warning(
                   'Failed to launch test on simulator. Will relaunch again.')
               continue
 
-        return (runner_exit_codes.EXITCODE.TEST_NOT_START,
-                output_str if return_output else None)
+        return runner_exit_codes.EXITCODE.TEST_NOT_START, output
       finally:
-        _DeleteTestCacheFileDirs(output.getvalue(), self._sdk, self._test_type)
+        if on_device:
+          _DeleteTestCacheFileDirs(output_chunks, self._test_type)
 
-  def _GetResultForXcodebuildStuck(self, output, return_output):
-    """Gets the execution result for the xcodebuild stuck case."""
+  def _GetResultForXcodebuildStuck(self, output):
+    """Gets the execution result for the xcodebuild stuck case.
+
+    Args:
+      output: string, the output of xcodebuild test command or None if it is
+          not returned.
+
+    Returns:
+      a tuple of the exit code and the output with the error message.
+    """
     error_message = ('xcodebuild command can not launch test on '
                      'device/simulator in %ss.' % self._startup_timeout_sec)
     logging.error(error_message)
-    output.write(error_message)
-    output_str = output.getvalue()
+    if output is not None:
+      output += error_message
     if self._sdk == ios_constants.SDK.IPHONEOS:
-      return (runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE,
-              output_str if return_output else None)
-    return (runner_exit_codes.EXITCODE.TEST_NOT_START,
-            output_str if return_output else None)
+      return runner_exit_codes.EXITCODE.NEED_REBOOT_DEVICE, output
+    return runner_exit_codes.EXITCODE.TEST_NOT_START, output
 
-  def _NeedRebootSim(self, output_str):
+  def _NeedRebootSim(self, output_errors):
     """Checks if need reboot the simulator."""
-    if (self._test_type == ios_constants.TestType.XCUITEST and
-        _BACKGROUND_TEST_RUNNER_ERROR in output_str):
-      return True
+    return (self._test_type == ios_constants.TestType.XCUITEST and
+            'BACKGROUND_TEST_RUNNER_ERROR' in output_errors)
 
-  def _NeedRecreateSim(self, output_str):
+  def _NeedRecreateSim(self, output_errors):
     """Checks if need recreate a new simulator."""
-    if re.search(_APP_UNKNOWN_TO_FRONTEND_PATTERN, output_str):
-      return True
-    if _REQUEST_DENIED_ERROR in output_str:
-      return True
-    if _INIT_SIM_SERVICE_ERROR in output_str:
-      return True
-    return False
-
-  def _NeedRetryForDeviceTesting(self, output_str):
+    return 'NEED_RECREATE_SIM' in output_errors
+
+  def _NeedRetryForDeviceTesting(self, output_errors):
     """Returns true if the device testing needs retry."""
-    return (re.search(_DEVICE_TYPE_WAS_NULL_PATTERN, output_str) or
-            _LOST_CONNECTION_ERROR in output_str or
-            _LOST_CONNECTION_TO_DTSERVICEHUB_ERROR in output_str or
-            _DEVICE_NO_LONGER_CONNECTED in output_str or
-            _UNABLE_FIND_DEVICE_IDENTIFIER in output_str)
-
-
-def _DeleteTestCacheFileDirs(xcodebuild_test_output, sdk, test_type):
-  """Deletes the cache files of the test session according to arguments."""
-  if sdk == ios_constants.SDK.IPHONEOS:
-    max_cache_dir_num = 1
-    if test_type == ios_constants.TestType.XCUITEST:
-      # Because XCUITest will install two apps (app under test and
-      # XCTRunner.app) on the device.
-      max_cache_dir_num = 2
-    test_cache_file_dirs = _FetchTestCacheFileDirs(xcodebuild_test_output,
-                                                   max_cache_dir_num)
+    return 'NEED_RETRY_DEVICE_TEST' in output_errors
+
+
+def _ReadCompleteLines(fd, check_xcodebuild_stuck):
+  """Reads the fd until EOF and yields the output in blocks of complete lines.
+
+  The output is read in chunks of up to _OUTPUT_READ_SIZE bytes when the fd is
+  readable. The trailing partial line of a chunk is carried to the next block.
+  While waiting for the output, the xcodebuild stuck timeout is checked in the
+  same loop.
+
+  Args:
+    fd: int, the file descriptor to read.
+    check_xcodebuild_stuck: CheckXcodebuildStuck, the checker of the process
+        which writes to the fd.
+
+  Yields:
+    bytes, the complete lines read from the fd. The last block may not end
+    with a newline.
+  """
+  with selectors.DefaultSelector() as selector:
+    selector.register(fd, selectors.EVENT_READ)
+    carry = b''
+    while True:
+      if not selector.select(check_xcodebuild_stuck.GetTimeout()):
+        check_xcodebuild_stuck.Check()
+        continue
+      chunk = os.read(fd, _OUTPUT_READ_SIZE)
+      if not chunk:
+        if carry:
+          yield carry
+        return
+      end = chunk.rfind(b'\n') + 1
+      if not end:
+        carry += chunk
+        continue
+      yield carry + chunk[:end]
+      carry = chunk[end:]
+
+
+def _WriteToStdout(data):
+  """Writes the raw bytes to stdout and flushes it."""
+  stdout_buffer = getattr(sys.stdout, 'buffer', None)
+  if stdout_buffer is None:
+    sys.stdout.write(data.decode('utf-8', errors='replace'))
+    sys.stdout.flush()
+    return
+  # Flushes the text layer first to keep the order with the printed text.
+  sys.stdout.flush()
+  stdout_buffer.write(data)
+  stdout_buffer.flush()
+
+
+def _DecodeOutput(data):
+  """Decodes the xcodebuild output bytes to string for the error checks."""
+  return data.decode('ascii', errors='ignore')
+
+
+def _DeleteTestCacheFileDirs(xcodebuild_test_output_chunks, test_type):
+  """Deletes the cache files of the test session on the real device."""
+  max_cache_dir_num = 1
+  if test_type == ios_constants.TestType.XCUITEST:
+    # Because XCUITest will install two apps (app under test and
+    # XCTRunner.app) on the device.
+    max_cache_dir_num = 2
+  test_cache_file_dirs = _FetchTestCacheFileDirs(
+      xcodebuild_test_output_chunks, max_cache_dir_num)
+  test_cache_file_dirs = [
+      cache_dir for cache_dir in test_cache_file_dirs
+      if os.path.exists(cache_dir)
+  ]
+  if not test_cache_file_dirs:
+    return
+  for cache_dir in test_cache_file_dirs:
+    logging.info('Removing cache files directory: %s', cache_dir)
+  # Removes the directories of many small files in parallel to overlap the
+  # file system calls.
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=len(test_cache_file_dirs)) as executor:
     for cache_dir in test_cache_file_dirs:
-      if os.path.exists(cache_dir):
-        logging.info('Removing cache files directory: %s', cache_dir)
-        shutil.rmtree(cache_dir)
+      executor.submit(shutil.rmtree, cache_dir, ignore_errors=True)
+
 
+@functools.lru_cache(maxsize=None)
+def _GetTestCacheFileDirPrefix():
+  """Gets the path prefix of the test cache file directory as bytes."""
+  return (xcode_info_util.GetXcodeEmbeddedAppDeltasDir() + '/').encode()
 
-def _FetchTestCacheFileDirs(xcodebuild_test_output, max_dir_num=1):
+
+def _FetchTestCacheFileDirs(xcodebuild_test_output_chunks, max_dir_num=1):
   """Fetches the cache file directories of this test session.
 
   When using `xcodebuild` to run test on iOS real device, it will generate some
@@ -338,28 +475,57 @@ def _FetchTestCacheFileDirs(xcodebuild_test_output, max_dir_num=1):
   DARWIN_USER_CACHE_DIR/com.apple.DeveloperTools/All/Xcode/EmbeddedAppDeltas.
 
   Args:
-    xcodebuild_test_output: string, the `xcodebuild test` output of this test
-        session.
+    xcodebuild_test_output_chunks: list of bytes, the `xcodebuild test`
+        output of this test session in blocks of complete lines.
     max_dir_num: int, the max number of test cache files potentially.
 
   Returns:
     an array of this test's EmbeddedAppDeltas directories.
   """
-  xcode_cache_dir = xcode_info_util.GetXcodeEmbeddedAppDeltasDir()
-  pattern = re.compile('(%s/[a-z0-9]+)/' % re.escape(xcode_cache_dir))
-  start_pos = 0
+  prefix = _GetTestCacheFileDirPrefix()
   cache_file_dirs = set()
-  while (start_pos < len(xcodebuild_test_output) and
-         len(cache_file_dirs) < max_dir_num):
-    match = pattern.search(xcodebuild_test_output, start_pos)
-    if not match:
-      break
-    cache_file_dirs.add(match.group(1))
-    start_pos = match.end(1)
+  # The directory path does not span lines, so each block is searched alone
+  # without joining the output. The fixed prefix is found by bytes.find, and
+  # only the directory name after it is checked char by char.
+  for chunk in xcodebuild_test_output_chunks:
+    pos = chunk.find(prefix)
+    while pos >= 0:
+      name_start = pos + len(prefix)
+      name_end = name_start
+      while (name_end < len(chunk) and
+             chunk[name_end] in _TEST_CACHE_FILE_DIR_NAME_CHARS):
+        name_end += 1
+      if name_end > name_start and chunk[name_end:name_end + 1] == b'/':
+        cache_file_dirs.add(chunk[pos:name_end].decode())
+        if len(cache_file_dirs) >= max_dir_num:
+          return cache_file_dirs
+        pos = chunk.find(prefix, name_end)
+      else:
+        pos = chunk.find(prefix, pos + 1)
   return cache_file_dirs
 
 
-def _ReadFileTailInShell(file_path, line):
-  """Tails the file in the last several lines."""
-  return subprocess.check_output(['tail', '-%d' % line,
-                                  file_path]).decode('utf-8')
+def _ReadFileTail(file_path, line):
+  """Reads the last several lines of the file.
+
+  The file is read backwards in blocks until it has enough lines, without
+  spawning `tail`.
+
+  Args:
+    file_path: string, the path of the file.
+    line: int, the number of the last lines to read.
+
+  Returns:
+    string, the last lines of the file.
+  """
+  with open(file_path, 'rb') as f:
+    pos = f.seek(0, os.SEEK_END)
+    data = b''
+    # The trailing newline of the file does not end a line to read.
+    while pos > 0 and data.count(b'\n', 0, len(data) - 1) < line:
+      read_size = min(_OUTPUT_READ_SIZE, pos)
+      pos -= read_size
+      f.seek(pos)
+      data = f.read(read_size) + data
+  lines = data.splitlines(keepends=True)[-line:]
+  return b''.join(lines).decode('utf-8', errors='replace')
@@ -235,12 +235,8 @@ class XctestRun(object):
     Returns:
       boolean, if the specific field is in the xctestrun file.
     """
-    try:
-      self._xctestrun_file_plist_obj.GetPlistField(
-          '%s:%s' % (self._root_key, field))
-      return True
-    except ios_errors.PlistError:
-      return False
+    return self._xctestrun_file_plist_obj.HasPlistField(
+        '%s:%s' % (self._root_key, field))
 
   def SetXctestrunField(self, field, value):
     """Sets the field with provided value in xctestrun file.
@@ -472,6 +468,7 @@ class XctestRunFactory(object):
       test_bundle_signing_identity = bundle_util.GetCodesignIdentity(
           self._test_bundle_dir)
 
+      xcode_version = xcode_info_util.GetXcodeVersionNumber()
       runner_app_frameworks_dir = os.path.join(uitest_runner_app, 'Frameworks')
       os.mkdir(runner_app_frameworks_dir)
       _CopyAndSignFramework(
@@ -481,7 +478,7 @@ class XctestRunFactory(object):
           os.path.join(platform_library_path,
                        'PrivateFrameworks/XCTAutomationSupport.framework'),
           runner_app_frameworks_dir, test_bundle_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1100:
+      if xcode_version >= 1100:
         _CopyAndSignLibFile(
             os.path.join(platform_path, _LIB_XCTEST_SWIFT_RELATIVE_PATH),
             runner_app_frameworks_dir, test_bundle_signing_identity)
@@ -489,7 +486,7 @@ class XctestRunFactory(object):
           uitest_runner_app,
           entitlements_plist_path=entitlements_plist_path,
           identity=test_bundle_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1300:
+      if xcode_version >= 1300:
         _CopyAndSignFramework(
           os.path.join(platform_library_path,
                        'PrivateFrameworks/XCUIAutomation.framework'),
@@ -502,13 +499,13 @@ class XctestRunFactory(object):
           os.path.join(platform_library_path,
                        'PrivateFrameworks/XCUnit.framework'),
           runner_app_frameworks_dir, test_bundle_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1430:
+      if xcode_version >= 1430:
          _CopyAndSignFramework(
            os.path.join(platform_library_path,
                     'PrivateFrameworks/XCTestSupport.framework'),
            runner_app_frameworks_dir, test_bundle_signing_identity)
-      bundle_util.CodesignBundle(self._test_bundle_dir)
-      bundle_util.CodesignBundle(self._app_under_test_dir)
+      bundle_util.CodesignBundles(
+          [self._test_bundle_dir, self._app_under_test_dir])
 
     platform_name = 'iPhoneOS' if self._on_device else 'iPhoneSimulator'
     developer_path = '__PLATFORMS__/%s.platform/Developer' % platform_name
@@ -552,21 +549,17 @@ class XctestRunFactory(object):
                                      uitest_runner_app_name + '.app')
     if os.path.exists(uitest_runner_app):
       shutil.rmtree(uitest_runner_app)
-    shutil.copytree(xctrunner_app, uitest_runner_app)
-    uitest_runner_exec = os.path.join(uitest_runner_app, uitest_runner_app_name)
-    shutil.move(
-        os.path.join(uitest_runner_app, 'XCTRunner'), uitest_runner_exec)
     # XCTRunner is multi-archs. When launching XCTRunner on arm64e device, it
     # will be launched as arm64e process by default. If the test bundle is arm64
     # bundle, the XCTRunner which hosts the test bundle will fail to be
     # launched. So removing the arm64e arch from XCTRunner can resolve this
     # case.
     test_executable = os.path.join(self._test_bundle_dir, test_bundle_name)
+    removed_arch = None
     if self._device_arch == ios_constants.ARCH.ARM64E:
       test_archs = bundle_util.GetFileArchTypes(test_executable)
       if ios_constants.ARCH.ARM64E not in test_archs:
-        bundle_util.RemoveArchType(uitest_runner_exec,
-                                   ios_constants.ARCH.ARM64E)
+        removed_arch = ios_constants.ARCH.ARM64E
     # XCTRunner is multi-archs. When launching XCTRunner on Apple silicon
     # simulator, it will be launched as arm64 process by default. If the test
     # bundle is still x86_64, the XCTRunner which hosts the test bundle will
@@ -575,14 +568,29 @@ class XctestRunFactory(object):
     elif not self._on_device:
       test_archs = bundle_util.GetFileArchTypes(test_executable)
       if ios_constants.ARCH.X86_64 in test_archs:
-        bundle_util.RemoveArchType(uitest_runner_exec, ios_constants.ARCH.ARM64)
+        removed_arch = ios_constants.ARCH.ARM64
+
+    # The executable is written by a single copy or lipo rewrite to its final
+    # name, instead of being copied with the app and rewritten in place.
+    xctrunner_exec = os.path.join(xctrunner_app, 'XCTRunner')
+    uitest_runner_exec = os.path.join(uitest_runner_app, uitest_runner_app_name)
+    shutil.copytree(
+        xctrunner_app, uitest_runner_app,
+        ignore=lambda src, names: ['XCTRunner'] if src == xctrunner_app else [])
+    if removed_arch:
+      bundle_util.RemoveArchTypes(
+          xctrunner_exec, [removed_arch], output_path=uitest_runner_exec)
+      shutil.copymode(xctrunner_exec, uitest_runner_exec)
+    else:
+      shutil.copy2(xctrunner_exec, uitest_runner_exec)
 
     runner_app_info_plist_path = os.path.join(uitest_runner_app, 'Info.plist')
     info_plist = plist_util.Plist(runner_app_info_plist_path)
-    info_plist.SetPlistField('CFBundleName', uitest_runner_app_name)
-    info_plist.SetPlistField('CFBundleExecutable', uitest_runner_app_name)
-    info_plist.SetPlistField('CFBundleIdentifier',
-                             'com.apple.test.' + uitest_runner_app_name)
+    info_plist.SetPlistFields({
+        'CFBundleName': uitest_runner_app_name,
+        'CFBundleExecutable': uitest_runner_app_name,
+        'CFBundleIdentifier': 'com.apple.test.' + uitest_runner_app_name,
+    })
 
     return uitest_runner_app
 
@@ -631,6 +639,7 @@ class XctestRunFactory(object):
         os.mkdir(app_under_test_frameworks_dir)
       app_under_test_signing_identity = bundle_util.GetCodesignIdentity(
           self._app_under_test_dir)
+      xcode_version = xcode_info_util.GetXcodeVersionNumber()
       _CopyAndSignFramework(
           os.path.join(platform_path,
                        'Developer/Library/Frameworks/XCTest.framework'),
@@ -639,7 +648,7 @@ class XctestRunFactory(object):
           platform_path, 'Developer/usr/lib/libXCTestBundleInject.dylib')
       _CopyAndSignLibFile(bundle_injection_lib, app_under_test_frameworks_dir,
                           app_under_test_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1100:
+      if xcode_version >= 1100:
         _CopyAndSignFramework(
             os.path.join(
                 platform_path, 'Developer/Library/PrivateFrameworks/'
@@ -648,7 +657,7 @@ class XctestRunFactory(object):
         _CopyAndSignLibFile(
             os.path.join(platform_path, _LIB_XCTEST_SWIFT_RELATIVE_PATH),
             app_under_test_frameworks_dir, app_under_test_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1300:
+      if xcode_version >= 1300:
         _CopyAndSignFramework(
             os.path.join(
                 platform_path, 'Developer/Library/PrivateFrameworks/'
@@ -664,7 +673,7 @@ class XctestRunFactory(object):
                 platform_path, 'Developer/Library/PrivateFrameworks/'
                 'XCUnit.framework'),
             app_under_test_frameworks_dir, app_under_test_signing_identity)
-      if xcode_info_util.GetXcodeVersionNumber() >= 1430:
+      if xcode_version >= 1430:
         _CopyAndSignFramework(
             os.path.join(
                 platform_path,
@@ -673,8 +682,8 @@ class XctestRunFactory(object):
             app_under_test_frameworks_dir,
             app_under_test_signing_identity,
         )
-      bundle_util.CodesignBundle(self._test_bundle_dir)
-      bundle_util.CodesignBundle(self._app_under_test_dir)
+      bundle_util.CodesignBundles(
+          [self._test_bundle_dir, self._app_under_test_dir])
 
     app_under_test_name = os.path.splitext(
         os.path.basename(self._app_under_test_dir))[0]